@@ -0,0 +1,240 @@
+#!/usr/bin/env python3
+# ESP-IDF application image (.bin) parser.
+#
+# Fields are unpacked with struct straight from a memoryview of the image,
+# or from the few UF2 blocks that hold them, only when asked for. Segment
+# data is never copied, so reading the version of an app, a .uf2 artifact
+# or a board's CURRENT.UF2 touches a few hundred bytes instead of decoding
+# the whole image.
+import mmap
+import struct
+import sys
+
+IMAGE_MAGIC = 0xE9
+APP_DESC_MAGIC = 0xABCD5432
+# Start of the first app partition; where the app sits in UF2 files that
+# cover the flash from address 0
+APP_OFFSET = 0x10000
+
+# magic, segment count, SPI mode, SPI speed/size, entry address, then the
+# extended header: WP pin, SPI pin drive, chip ID, minimum chip revision,
+# min/max full chip revision, reserved, hash appended
+IMAGE_HEADER = struct.Struct("<BBBBIB3sHBHH4sB")
+# load address, length
+SEGMENT_HEADER = struct.Struct("<II")
+# magic, secure version, reserved, version, project name, compile time and
+# date, IDF version, SHA-256 of the ELF
+APP_DESC = struct.Struct("<II8s32s32s16s16s32s32s")
+APP_DESC_OFFSET = IMAGE_HEADER.size + SEGMENT_HEADER.size
+
+CHIP_NAMES = {0: "ESP32", 2: "ESP32-S2", 5: "ESP32-C3", 9: "ESP32-S3", 12: "ESP32-C2",
+              13: "ESP32-C6", 16: "ESP32-H2", 18: "ESP32-P4"}
+
+
+def _str(raw):
+    return bytes(raw).split(b"\0", 1)[0].decode("utf-8", "replace")
+
+
+class Segment:
+    def __init__(self, load_addr, offset, length):
+        # Target load address, and where the data sits in the image
+        self.load_addr = load_addr
+        self.offset = offset
+        self.length = length
+
+
+class EspImage:
+    def __init__(self, read):
+        # `read(offset, length)` returns image bytes; see from_buffer and
+        # from_uf2. Only the header is read here.
+        self._read = read
+        hd = self._unpack(IMAGE_HEADER, 0)
+        if hd[0] != IMAGE_MAGIC:
+            raise ValueError("Not an ESP app image (magic 0x%02x)" % hd[0])
+        self.segment_count = hd[1]
+        self.spi_mode = hd[2]
+        self.entry = hd[4]
+        self.chip_id = hd[7]
+        self.hash_appended = bool(hd[12])
+        self._segments = None
+        self._desc = None
+
+    @classmethod
+    def from_buffer(cls, buf):
+        # bytes, bytearray or an mmap of a .bin; segments are views into it
+        view = memoryview(buf)
+        return cls(lambda offset, length: view[offset:offset + length])
+
+    @classmethod
+    def from_uf2(cls, path, address=None, family=None):
+        # The image at target `address` of a UF2 file, by default at its
+        # first block, or at APP_OFFSET if that does not hold an image
+        import uf2conv
+        reader = uf2conv.UF2Reader(path, family)
+        if address == None:
+            address = reader.start
+            if reader.read(address, 1)[0] != IMAGE_MAGIC:
+                address = APP_OFFSET
+        return cls(lambda offset, length: reader.read(address + offset, length))
+
+    def _unpack(self, st, offset):
+        data = self._read(offset, st.size)
+        if len(data) < st.size:
+            raise ValueError("Image ends at offset 0x%x" % (offset + len(data)))
+        return st.unpack(data)
+
+    @property
+    def chip(self):
+        return CHIP_NAMES.get(self.chip_id, "chip %d" % self.chip_id)
+
+    @property
+    def segments(self):
+        if self._segments == None:
+            segments = []
+            offset = IMAGE_HEADER.size
+            for _ in range(self.segment_count):
+                load_addr, length = self._unpack(SEGMENT_HEADER, offset)
+                segments.append(Segment(load_addr, offset + SEGMENT_HEADER.size, length))
+                offset += SEGMENT_HEADER.size + length
+            self._segments = segments
+        return self._segments
+
+    def data(self, segment):
+        return self._read(segment.offset, segment.length)
+
+    @property
+    def length(self):
+        # Image size up to and including the checksum byte, which pads the
+        # segments to a multiple of 16 bytes
+        end = IMAGE_HEADER.size
+        if self.segments:
+            end = self.segments[-1].offset + self.segments[-1].length
+        return (end + 16) // 16 * 16
+
+    @property
+    def app_desc(self):
+        # The fields of esp_app_desc_t at the start of the first segment,
+        # or None for images without one (e.g. a bootloader)
+        if self._desc == None:
+            desc = self._unpack(APP_DESC, APP_DESC_OFFSET)
+            if desc[0] != APP_DESC_MAGIC:
+                return None
+            self._desc = {
+                "secure_version": desc[1],
+                "version": _str(desc[3]),
+                "project_name": _str(desc[4]),
+                "time": _str(desc[5]),
+                "date": _str(desc[6]),
+                "idf_version": _str(desc[7]),
+                "elf_sha256": bytes(desc[8]).hex(),
+            }
+        return self._desc
+
+    @property
+    def version(self):
+        desc = self.app_desc
+        return desc["version"] if desc else None
+
+    @property
+    def sha256(self):
+        # Hex SHA-256 appended after the checksum, or None
+        if not self.hash_appended:
+            return None
+        digest = self._read(self.length, 32)
+        if len(digest) < 32:
+            raise ValueError("Image ends before its SHA-256")
+        return bytes(digest).hex()
+
+    def verify(self):
+        # Reads the whole image; returns a list of problems, empty if the
+        # checksum and the appended hash match
+        import hashlib
+        problems = []
+        checksum = 0xEF
+        for segment in self.segments:
+            data = self.data(segment)
+            if len(data) < segment.length:
+                return ["Segment at 0x%x is cut short" % segment.offset]
+            checksum ^= _xor(data)
+        stored = self._read(self.length - 1, 1)
+        if len(stored) < 1 or stored[0] != checksum:
+            problems.append("Checksum mismatch")
+        if self.hash_appended:
+            digest = hashlib.sha256(self._read(0, self.length)).hexdigest()
+            if digest != self.sha256:
+                problems.append("SHA-256 mismatch")
+        return problems
+
+
+def _xor(data):
+    # XOR of all bytes, folded down from 64-bit words
+    data = bytes(data)
+    words = len(data) // 8
+    value = 0
+    for word in struct.unpack_from("<%dQ" % words, data):
+        value ^= word
+    for byte in data[8 * words:]:
+        value ^= byte
+    value ^= value >> 32
+    value ^= value >> 16
+    value ^= value >> 8
+    return value & 0xFF
+
+
+def open_image(path, address=None):
+    """Return an EspImage for a .bin or .uf2 file (e.g. a mounted CURRENT.UF2)"""
+    with open(path, "rb") as f:
+        head = f.read(8)
+        if len(head) == 8 and struct.unpack("<I", head[:4])[0] == 0x0A324655:
+            return EspImage.from_uf2(path, address)
+        if not head:
+            raise ValueError("%s is empty" % path)
+        # The mapping stays alive as long as the image's views of it
+        return EspImage.from_buffer(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ))
+
+
+def describe(image):
+    lines = ["Chip: %s, entry 0x%08x, %d segments" %
+             (image.chip, image.entry, image.segment_count)]
+    desc = image.app_desc
+    if desc:
+        lines.append("Project: %s, version %s" % (desc["project_name"], desc["version"]))
+        lines.append("Built %s %s with ESP-IDF %s" % (desc["date"], desc["time"], desc["idf_version"]))
+        lines.append("ELF SHA-256: %s" % desc["elf_sha256"])
+    for segment in image.segments:
+        lines.append("  segment at 0x%08x, %d bytes" % (segment.load_addr, segment.length))
+    if image.hash_appended:
+        lines.append("Image SHA-256: %s" % image.sha256)
+    return lines
+
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description='Show the header of an ESP-IDF app image '
+                                                 '(.bin, .uf2 or a board\'s CURRENT.UF2).')
+    parser.add_argument('image', metavar='IMAGE', nargs='+')
+    parser.add_argument('-a', '--address', type=str,
+                        help='target address of the app in UF2 files (default: first block, '
+                             'else 0x10000)')
+    parser.add_argument('--verify', action='store_true',
+                        help='also check the checksum and SHA-256 (reads the whole image)')
+    args = parser.parse_args()
+    status = 0
+    for path in args.image:
+        try:
+            image = open_image(path, int(args.address, 0) if args.address else None)
+            if len(args.image) > 1:
+                print("%s:" % path)
+            for line in describe(image):
+                print(line)
+            if args.verify:
+                problems = image.verify()
+                for line in problems:
+                    print(line)
+                if not problems:
+                    print("Checksum and SHA-256 OK")
+                status = status or (1 if problems else 0)
+        except (OSError, ValueError) as e:
+            print("%s: %s" % (path, e), file=sys.stderr)
+            status = 1
+    sys.exit(status)
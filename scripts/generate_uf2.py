@@ -1,11 +1,78 @@
 #!/usr/bin/env python3
 
+import glob
 import os
-import subprocess
 import sys
 
 Import("env")
 
+# uf2families.json entry for ESP32S3; kept here so the post-action does not
+# have to parse the family table on every link
+ESP32S3_FAMILY = 0xc47e5767
+
+# App partition start of the default ESP32 partition tables, used for
+# flash-addressed bootloaders when the project's table cannot be read
+APP_BASE = 0x10000
+
+UF2_DRIVE_PATTERNS = [
+    "/media/*/FTHRS3BOOT",
+    "/media/$USER/FTHRS3BOOT",
+    "/Volumes/FTHRS3BOOT"  # macOS
+]
+
+
+def find_uf2_drive():
+    """Return the first mounted UF2 bootloader drive, or None"""
+    for path_pattern in UF2_DRIVE_PATTERNS:
+        matches = glob.glob(os.path.expandvars(path_pattern))
+        if matches:
+            return matches[0]
+    return None
+
+
+def app_base(uf2conv, env, project_dir, family):
+    """Return the UF2 address the bootloader writes the app image from.
+
+    TinyUF2 on the ESP32-S2/S3 only writes the app partition and numbers
+    it from 0, so the image starts at 0 whatever the partition table says.
+    For bootloaders using flash addresses the firmware .bin, an esptool
+    app image rather than the ELF's load addresses, goes where the table
+    puts the app: the factory partition, otherwise the first OTA slot.
+    """
+    if uf2conv.partition_relative(family):
+        return 0
+    table = env.GetProjectOption("board_build.partitions", "")
+    if not table:
+        return APP_BASE
+    try:
+        parts = uf2conv.read_partitions(os.path.join(project_dir, table))
+    except (OSError, ValueError) as e:
+        print(f"Warning: could not read partition table {table} ({e}), using 0x{APP_BASE:x}")
+        return APP_BASE
+    apps = [p for p in parts if p[1] == "app"]
+    for part in apps:
+        if part[2] == "factory":
+            return part[3]
+    return apps[0][3] if apps else APP_BASE
+
+
+def convert(uf2conv, converter, firmware_bin, names, devices=()):
+    """Stream the binary into every named output and drive file in a single pass.
+
+    Drive files go through uf2conv's device writer, which returns only
+    after fsync, so the board has the firmware once this does.
+    """
+    with open(firmware_bin, "rb") as reader:
+        return uf2conv.write_stream(names, converter.iter_uf2_blocks(reader), devices=devices)
+
+
+def copy_to(uf2conv, firmware_uf2, devices):
+    """Stream an already converted UF2 to the drive files"""
+    with open(firmware_uf2, "rb") as reader:
+        return uf2conv.write_stream([], iter(lambda: reader.read(1024 * 1024), b""),
+                                    devices=devices)
+
+
 def generate_uf2(source, target, env):
     """Generate UF2 file from firmware binary for ESP32-S3 TFT Feather"""
 
@@ -13,7 +80,8 @@ def generate_uf2(source, target, env):
     firmware_bin = str(target[0]).replace('.elf', '.bin')
     firmware_uf2 = str(target[0]).replace('.elf', '.uf2')
 
-    # Path to uf2conv.py (should be in project root)
+    # uf2conv.py (should be in project root) is used as a library, which
+    # saves an interpreter start and argument parsing on every link
     project_dir = env.subst("$PROJECT_DIR")
     uf2conv_path = os.path.join(project_dir, "uf2conv.py")
 
@@ -26,50 +94,52 @@ def generate_uf2(source, target, env):
         return
 
     try:
-        # Convert binary to UF2 format for ESP32-S3
-        # Base address 0x10000 is the standard app partition start for ESP32-S3
-        cmd = [
-            sys.executable, uf2conv_path,
-            firmware_bin,
-            "--base", "0x10000",
-            "--family", "ESP32S3",
-            "--output", firmware_uf2
-        ]
-
-        print(f"Generating UF2: {' '.join(cmd)}")
-        result = subprocess.run(cmd, capture_output=True, text=True)
-
-        if result.returncode == 0:
-            print(f"✅ UF2 generated successfully: {firmware_uf2}")
-            print(f"📁 File size: {os.path.getsize(firmware_uf2)} bytes")
-
-            # Check if UF2 bootloader drive is mounted
-            uf2_paths = [
-                "/media/*/FTHRS3BOOT",
-                "/media/$USER/FTHRS3BOOT",
-                "/Volumes/FTHRS3BOOT"  # macOS
-            ]
-
-            for path_pattern in uf2_paths:
-                import glob
-                matches = glob.glob(path_pattern)
-                if matches:
-                    uf2_drive = matches[0]
-                    try:
-                        import shutil
-                        dest_file = os.path.join(uf2_drive, "NEW.UF2")
-                        shutil.copy2(firmware_uf2, dest_file)
-                        print(f"🚀 Automatically flashed to {uf2_drive}")
-                        break
-                    except Exception as e:
-                        print(f"Could not auto-flash to {uf2_drive}: {e}")
+        if project_dir not in sys.path:
+            sys.path.insert(0, project_dir)
+        import uf2conv
+
+        converter = uf2conv.UF2Converter(app_base(uf2conv, env, project_dir, ESP32S3_FAMILY),
+                                         ESP32S3_FAMILY)
+        uf2_drive = find_uf2_drive()
+        drive_names = []
+        if uf2_drive:
+            drive_names.append(os.path.join(uf2_drive, "NEW.UF2"))
+
+        # Identical relinks skip conversion; set UF2CONV_NO_CACHE=1 to force it
+        cache = None
+        if not os.environ.get("UF2CONV_NO_CACHE"):
+            cache = uf2conv.ConversionCache(os.path.join(project_dir, ".pio", "uf2cache"))
+            cache_key = cache.key(firmware_bin, converter, "uf2")
+
+        reused = bool(cache) and cache.fetch(cache_key, firmware_uf2)
+        try:
+            if reused:
+                print(f"♻️  Firmware unchanged, reused cached UF2: {firmware_uf2}")
+                if drive_names:
+                    copy_to(uf2conv, firmware_uf2, drive_names)
             else:
-                print("💡 To flash: Double-click RESET button and copy firmware.uf2 to FTHRS3BOOT drive")
-
+                names = [firmware_uf2] + drive_names
+                print(f"Generating UF2: {firmware_bin} -> {', '.join(names)}")
+                uf2conv.remove_file(firmware_uf2)
+                convert(uf2conv, converter, firmware_bin, [firmware_uf2], drive_names)
+        except OSError as e:
+            if not uf2_drive:
+                raise
+            print(f"Could not auto-flash to {uf2_drive}: {e}")
+            uf2_drive = None
+            if not reused:
+                uf2conv.remove_file(firmware_uf2)
+                convert(uf2conv, converter, firmware_bin, [firmware_uf2])
+        if cache and not reused:
+            cache.store(cache_key, firmware_uf2)
+        size = os.path.getsize(firmware_uf2)
+
+        print(f"✅ UF2 generated successfully: {firmware_uf2}")
+        print(f"📁 File size: {size} bytes")
+        if uf2_drive:
+            print(f"🚀 Automatically flashed to {uf2_drive}")
         else:
-            print(f"❌ UF2 conversion failed:")
-            print(f"stdout: {result.stdout}")
-            print(f"stderr: {result.stderr}")
+            print("💡 To flash: Double-click RESET button and copy firmware.uf2 to FTHRS3BOOT drive")
 
     except Exception as e:
         print(f"❌ Error generating UF2: {e}")
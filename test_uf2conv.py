@@ -0,0 +1,197 @@
+#!/usr/bin/env python3
+# Tests for uf2conv; run with "python -m pytest -q test_uf2conv.py".
+import io
+import os
+import random
+import struct
+import subprocess
+import sys
+
+import pytest
+
+import uf2conv
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+ESP32S3 = 0xc47e5767
+
+
+def baseline_to_uf2(data, base, family):
+    # convert_to_uf2 as it was before the converter was reworked
+    numblocks = (len(data) + 255) // 256
+    flags = 0x2000 if family else 0x0
+    outp = []
+    for blockno in range(numblocks):
+        chunk = data[256 * blockno:256 * blockno + 256]
+        hd = struct.pack(b"<IIIIIIII", uf2conv.UF2_MAGIC_START0, uf2conv.UF2_MAGIC_START1,
+                         flags, base + 256 * blockno, 256, blockno, numblocks, family)
+        outp.append(hd + chunk.ljust(476, b"\x00") + struct.pack(b"<I", uf2conv.UF2_MAGIC_END))
+    return b"".join(outp)
+
+
+def baseline_from_uf2(buf):
+    # convert_from_uf2 as it was, for files of one family: payloads in file
+    # order, gaps between them filled with zeros
+    outp = []
+    curraddr = None
+    for ptr in range(0, len(buf) // 512 * 512, 512):
+        hd = struct.unpack(b"<IIIIIIII", buf[ptr:ptr + 32])
+        if hd[0] != uf2conv.UF2_MAGIC_START0 or hd[1] != uf2conv.UF2_MAGIC_START1 or hd[2] & 1:
+            continue
+        if curraddr == None:
+            curraddr = hd[3]
+        outp.append(bytes(hd[3] - curraddr))
+        outp.append(buf[ptr + 32:ptr + 32 + hd[4]])
+        curraddr = hd[3] + hd[4]
+    return b"".join(outp)
+
+
+def random_bytes(n, seed=0):
+    rng = random.Random(seed)
+    return bytes(rng.getrandbits(8) for _ in range(n))
+
+
+def run(*args):
+    return subprocess.run([sys.executable, os.path.join(HERE, "uf2conv.py")] + list(args),
+                          stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True)
+
+
+@pytest.mark.parametrize("size", [1, 255, 256, 1000, 70000])
+@pytest.mark.parametrize("base,family", [(0x2000, 0x0), (0x0, ESP32S3)])
+def test_encode_matches_baseline(size, base, family):
+    data = random_bytes(size, size)
+    expected = baseline_to_uf2(data, base, family)
+    conv = uf2conv.UF2Converter(base, family)
+    assert conv.to_uf2(data) == expected
+    assert b"".join(conv.iter_uf2_blocks(io.BytesIO(data), len(data))) == expected
+
+
+def gappy_uf2():
+    # Blocks at 0x1000, 0x1100 and 0x1400, so decoding has to pad
+    conv = uf2conv.UF2Converter(0x1000)
+    blocks = conv.to_uf2(random_bytes(1024, 1))
+    return bytes(blocks[:1024] + blocks[1536:])
+
+
+@pytest.mark.parametrize("name", ["firmware.uf2", "CURRENT.UF2", "gaps"])
+@pytest.mark.parametrize("fast", [True, False])
+def test_decode_matches_baseline(name, fast, monkeypatch):
+    if name == "gaps":
+        buf = gappy_uf2()
+    else:
+        with open(os.path.join(HERE, name), "rb") as f:
+            buf = f.read()
+    if not fast:
+        monkeypatch.setattr(uf2conv.UF2Converter, "contiguous_payload", lambda *args: None)
+    conv = uf2conv.UF2Converter()
+    assert conv.from_uf2(buf) == baseline_from_uf2(buf)
+    assert conv.base == struct.unpack_from(b"<I", buf, 12)[0]
+    streamed = b"".join(uf2conv.UF2Converter().iter_payload(io.BytesIO(buf)))
+    assert streamed == baseline_from_uf2(buf)
+
+
+def test_decode_rejects_overlapping_blocks():
+    blocks = uf2conv.UF2Converter(0x0).to_uf2(random_bytes(512))
+    with pytest.raises(ValueError):
+        uf2conv.UF2Converter().from_uf2(bytes(blocks + blocks[:512]))
+
+
+def test_sparse_image_add_and_read():
+    image = uf2conv.SparseImage()
+    image.add(0x100, b"b" * 16)
+    image.add(0x0, b"a" * 16)
+    image.add(0x110, b"c" * 16)
+    assert image.ranges() == [(0x0, 0x10), (0x100, 0x120)]
+    assert len(image) == 48
+    with pytest.raises(ValueError):
+        image.add(0x108, b"x")
+    assert image.read(0xc, 8, 0xff) == b"aaaa" + b"\xff" * 4
+    assert image.tobytes()[0xf0:] == bytes(16) + b"b" * 16 + b"c" * 16
+
+
+def test_sparse_image_pages_keep_to_the_grid():
+    image = uf2conv.SparseImage()
+    image.add(0x10010, b"x" * 0x100)
+    pages = list(image.pages(256))
+    assert [(addr, len(data)) for addr, data in pages] == [(0x10000, 256), (0x10100, 256)]
+    assert pages[0][1][:0x10] == b"\xff" * 0x10
+
+
+def test_sparse_image_pages_stop_at_bounds():
+    image = uf2conv.SparseImage()
+    image.add(0x10080, bytes(range(256)))
+    pages = list(image.pages(256, 0xff, [0x10080]))
+    assert [(addr, len(data)) for addr, data in pages] == [(0x10080, 128), (0x10100, 256)]
+    assert pages[0][1] + pages[1][1][:128] == bytes(range(256))
+    image = uf2conv.SparseImage()
+    image.add(0x0, b"x" * 0x300)
+    pages = list(image.pages(256, 0xff, [0x180]))
+    assert [(addr, len(data)) for addr, data in pages] == \
+        [(0x0, 256), (0x100, 128), (0x180, 128), (0x200, 256)]
+
+
+def test_skip_erased_round_trip(tmp_path):
+    data = b"A" * 300 + b"\xff" * 2000 + b"B" * 300
+    inp = tmp_path / "in.bin"
+    inp.write_bytes(data)
+    full, skipped, out = tmp_path / "full.uf2", tmp_path / "skipped.uf2", tmp_path / "out.bin"
+    assert run("-c", "-b", "0x0", str(inp), "-o", str(full)).returncode == 0
+    assert run("-c", "-E", "-b", "0x0", str(inp), "-o", str(skipped)).returncode == 0
+    assert skipped.stat().st_size < full.stat().st_size
+    assert run("-E", str(skipped), "-o", str(out)).returncode == 0
+    assert out.read_bytes()[:len(data)] == data
+
+
+def test_md5_round_trip(tmp_path):
+    data = random_bytes(3000)
+    inp, uf2, out = tmp_path / "in.bin", tmp_path / "md5.uf2", tmp_path / "out.bin"
+    inp.write_bytes(data)
+    assert run("-c", "-m", "-b", "0x0", str(inp), "-o", str(uf2)).returncode == 0
+    buf = bytearray(uf2.read_bytes())
+    assert all(hd[2] & 0x4000 for hd in uf2conv.UF2_BLOCK.iter_unpack(buf))
+    assert run(str(uf2), "-o", str(out)).returncode == 0
+    assert out.read_bytes()[:len(data)] == data
+    buf[512 + 40] ^= 1
+    uf2.write_bytes(buf)
+    result = run(str(uf2), "-o", str(out))
+    assert result.returncode == 1
+    assert "MD5 checksum mismatch at 512" in result.stderr
+
+
+def test_artifact_store_add_and_rebuild(tmp_path):
+    conv = uf2conv.UF2Converter(0x0, ESP32S3)
+    old = random_bytes(4096, 1)
+    new = old[:2048] + random_bytes(2048, 2)
+    (tmp_path / "old.uf2").write_bytes(conv.to_uf2(old))
+    (tmp_path / "new.uf2").write_bytes(conv.to_uf2(new))
+    store = uf2conv.ArtifactStore(str(tmp_path / "store"))
+    first, _, replaced = store.add(str(tmp_path / "old.uf2"))
+    assert replaced == None
+    # Only the eight blocks that changed are new
+    second, added, _ = store.add(str(tmp_path / "new.uf2"))
+    assert added == 8
+    assert store.rebuild(first) == (tmp_path / "old.uf2").read_bytes()
+    assert store.rebuild(second) == (tmp_path / "new.uf2").read_bytes()
+    assert store.resolve("new.uf2") == second
+    ranges = uf2conv.diff_blocks(store.block_map(first), store.block_map(second))
+    assert [(start, end) for start, end, _ in ranges] == [(2048, 4096)]
+
+
+def test_delta_against_board_record(tmp_path):
+    conv = uf2conv.UF2Converter(0x0, ESP32S3)
+    old = conv.to_uf2(random_bytes(4096, 1))
+    new = conv.to_uf2(random_bytes(256, 1) + random_bytes(256, 2) + random_bytes(4096, 1)[512:])
+    records = uf2conv.BoardRecords(str(tmp_path))
+    assert records.load("ESP32S3-board/1234") == {}
+    records.update("ESP32S3-board/1234", uf2conv.block_digests(old))
+    delta = uf2conv.delta_uf2(new, records.load("ESP32S3-board/1234"))
+    assert len(delta) == 512
+    hd = uf2conv.UF2_HEADER.unpack_from(delta)
+    assert (hd[3], hd[5], hd[6]) == (256, 0, 1)
+    assert delta[32:288] == new[512 + 32:512 + 288]
+    # Nothing changed: the first block still goes out
+    records.update("ESP32S3-board/1234", uf2conv.block_digests(delta))
+    again = uf2conv.delta_uf2(new, records.load("ESP32S3-board/1234"))
+    assert len(again) == 512
+    assert again[32:512] == new[32:512]
+    assert uf2conv.UF2_HEADER.unpack_from(again)[3:7] == (0, 256, 0, 1)
+    assert records.load("another-board") == {}
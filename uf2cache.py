@@ -0,0 +1,40 @@
+#!/usr/bin/env python3
+# Where uf2conv and uf2families keep their caches, and how they write them.
+#
+# Every cache file is written to a temporary name next to it and renamed
+# into place, so a reader never sees half a file and concurrent writers
+# only ever race to replace a complete one.
+import os
+import pickle
+
+
+def user_cache_dir():
+    base = os.environ.get("XDG_CACHE_HOME") or os.path.join(os.path.expanduser("~"), ".cache")
+    return os.path.join(base, "uf2conv")
+
+
+def write_atomic(path, write):
+    # Calls write(f) on a new binary file that then replaces `path`;
+    # errors propagate and leave `path` as it was
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    tmp = "%s.%d.tmp" % (path, os.getpid())
+    try:
+        with open(tmp, "wb") as f:
+            write(f)
+        os.replace(tmp, path)
+    except BaseException:
+        try:
+            os.remove(tmp)
+        except OSError:
+            pass
+        raise
+
+
+def save_pickle(path, obj):
+    # For caches, which are an optimisation only: returns False instead of
+    # failing when `path` cannot be written
+    try:
+        write_atomic(path, lambda f: pickle.dump(obj, f, pickle.HIGHEST_PROTOCOL))
+        return True
+    except OSError:
+        return False
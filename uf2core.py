@@ -0,0 +1,2650 @@
+#!/usr/bin/env python3
+import sys
+import array
+import bisect
+import mmap
+import struct
+import re
+import os
+import os.path
+import argparse
+import io
+import pickle
+import time
+from time import sleep
+
+import uf2cache
+import uf2families
+
+# hashlib, shutil, subprocess and tempfile are imported where they are
+# used; build scripts run this hundreds of times and most runs need none.
+
+
+UF2_MAGIC_START0 = 0x0A324655 # "UF2\n"
+UF2_MAGIC_START1 = 0x9E5D5157 # Randomly selected
+UF2_MAGIC_END    = 0x0AB16F30 # Ditto
+
+UF2_HEADER = struct.Struct(b"<IIIIIIII")
+UF2_FOOTER = struct.Struct(b"<I")
+# Header fields of a whole 512-byte block, for walking a buffer of blocks
+UF2_BLOCK = struct.Struct(b"<IIIIIIII480x")
+UF2_BLOCK_FULL = struct.Struct(b"<IIIIIIII476xI")
+# Flag 0x4000: target address, length and MD5 of a flash region, stored in
+# the last 24 bytes of the data area
+UF2_MD5 = struct.Struct(b"<II16s")
+UF2_MD5_OFFSET = 512 - 4 - UF2_MD5.size
+
+# Blocks handled per read/write in --stream mode (64 KiB of UF2)
+STREAM_CHUNK_BLOCKS = 128
+# Bytes per write() when flashing a drive, and the sizes --benchmark tries
+DEPLOY_CHUNK = 64 * 1024
+BENCH_CHUNK_SIZES = [4096 << i for i in range(9)]
+
+# Largest payload a 512-byte block has room for, and the payload sizes the
+# --benchmark run on an input compares
+UF2_MAX_PAYLOAD = 476
+UF2_MAX_MD5_PAYLOAD = UF2_MD5_OFFSET - 32
+BENCH_PAYLOAD_SIZES = (256, 476)
+# Families whose bootloaders only take 256-byte payloads (the RP2040 boot
+# ROM, uf2-samdx1 and the Adafruit nRF52 bootloader all insist on it, as
+# does TinyUF2, derived from uf2-samdx1, on the ESP32-S2 and -S3)
+FIXED_PAYLOAD_FAMILIES = ("RP2040", "RP2XXX_ABSOLUTE", "RP2XXX_DATA", "RP2350_ARM_S",
+                          "RP2350_RISCV", "RP2350_ARM_NS", "SAMD21", "SAMD51", "SAML21",
+                          "NRF52", "NRF52820", "NRF52832xxAA", "NRF52832xxAB",
+                          "NRF52833", "NRF52840", "ESP32S2", "ESP32S3")
+# Families whose bootloader (TinyUF2) only writes the app partition (ota_0)
+# and numbers it from 0: their UF2 files start at 0, not at the partition's
+# flash offset, and CURRENT.UF2 lists the partition from 0 as well
+PARTITION_RELATIVE_FAMILIES = ("ESP32S2", "ESP32S3")
+
+# Decoding without an erased value fills gaps between blocks with zeros,
+# which is not what flash holds there
+GAP_WARNING = ("Warning: gaps between blocks filled with 0x00; decode with -E to fill them "
+               "with erased flash")
+
+INFO_FILE = "/INFO_UF2.TXT"
+CURRENT_FILE = "/CURRENT.UF2"
+# --verify: how long a board may take to come back after flashing, and how
+# long to wait for it to go away at all (some bootloaders stay mounted)
+VERIFY_TIMEOUT = 60
+REMOUNT_GRACE = 5
+MOUNTINFO = "/proc/self/mountinfo"
+# File systems UF2 bootloaders present their drive as
+FAT_FSTYPES = ("vfat", "msdos", "exfat")
+# Seconds a newly mounted FAT drive is re-checked for INFO_UF2.TXT
+MOUNT_SETTLE = 5
+
+appstartaddr = 0x2000
+familyid = 0x0
+
+
+def is_uf2(buf):
+    w = struct.unpack("<II", buf[0:8])
+    return w[0] == UF2_MAGIC_START0 and w[1] == UF2_MAGIC_START1
+
+def is_hex(buf):
+    try:
+        w = buf[0:30].decode("utf-8")
+    except UnicodeDecodeError:
+        return False
+    if w[0] == ':' and re.match(rb"^[:0-9a-fA-F\r\n]+$", buf):
+        return True
+    return False
+
+def is_elf(buf):
+    return bytes(buf[0:4]) == b"\x7fELF"
+
+class SparseImage:
+    # Flash contents as sorted, non-overlapping (address, bytearray)
+    # segments, with data that continues a segment appended to it. Gaps
+    # take no memory until the image is read back, where each is filled
+    # with a single bytes multiplication, so conversions cost
+    # O(segments), not O(padding bytes).
+    def __init__(self):
+        self.starts = []
+        self.segments = []
+
+    def __len__(self):
+        # Bytes of data, not counting gaps
+        return sum(len(seg) for seg in self.segments)
+
+    @property
+    def start(self):
+        return self.starts[0] if self.starts else 0
+
+    @property
+    def end(self):
+        return self.starts[-1] + len(self.segments[-1]) if self.starts else 0
+
+    def ranges(self):
+        # [start, end) target address ranges holding data
+        return [(start, start + len(seg)) for start, seg in zip(self.starts, self.segments)]
+
+    def add(self, addr, data):
+        # Overlapping data raises ValueError rather than depending on the
+        # order records come in
+        end = addr + len(data)
+        i = bisect.bisect_right(self.starts, addr)
+        if (i and self.starts[i - 1] + len(self.segments[i - 1]) > addr) or \
+           (i < len(self.starts) and self.starts[i] < end):
+            raise ValueError("Data at 0x%x-0x%x overlaps earlier data" % (addr, end))
+        if not len(data):
+            return
+        if i and self.starts[i - 1] + len(self.segments[i - 1]) == addr:
+            i -= 1
+            self.segments[i] += data
+        else:
+            self.starts.insert(i, addr)
+            self.segments.insert(i, bytearray(data))
+        if i + 1 < len(self.starts) and self.starts[i + 1] == end:
+            self.segments[i] += self.segments.pop(i + 1)
+            del self.starts[i + 1]
+
+    def merge(self, other):
+        for start, seg in zip(other.starts, other.segments):
+            self.add(start, seg)
+
+    def read(self, addr, length, fill=0):
+        outp = bytearray([fill]) * length
+        end = addr + length
+        i = max(bisect.bisect_right(self.starts, addr) - 1, 0)
+        while i < len(self.starts) and self.starts[i] < end:
+            start, seg = self.starts[i], self.segments[i]
+            lo = max(addr, start)
+            hi = min(end, start + len(seg))
+            if lo < hi:
+                outp[lo - addr:hi - addr] = memoryview(seg)[lo - start:hi - start]
+            i += 1
+        return outp
+
+    def __getitem__(self, index):
+        # image[start:stop] reads target addresses start to stop, gaps as 0
+        if not isinstance(index, slice) or index.step not in (None, 1):
+            raise TypeError("SparseImage only supports address slices")
+        start = self.start if index.start == None else index.start
+        stop = self.end if index.stop == None else index.stop
+        return self.read(start, max(stop - start, 0))
+
+    def tobytes(self, fill=0):
+        return self.read(self.start, self.end - self.start, fill)
+
+    def pages(self, size, fill=0xFF, bounds=()):
+        # (address, data) of the `size`-byte pages holding data, in order.
+        # Power-of-two sizes keep pages on the size-aligned grid, as page
+        # based bootloaders want; other sizes start each run of pages where
+        # its data does, so no page writes fill below the image. No page
+        # crosses an address in `bounds` (e.g. partition offsets): a run
+        # starts no lower than the last bound at or below it, and a page
+        # reaching past one is cut short there, the next one returning to
+        # the grid.
+        aligned = size & (size - 1) == 0
+        bounds = sorted(bounds)
+        done = None
+        for start, end in self.ranges():
+            cuts = bounds[bisect.bisect_right(bounds, start):bisect.bisect_left(bounds, end)]
+            for lo, hi in zip([start] + cuts, cuts + [end]):
+                page = lo - lo % size if aligned else lo
+                i = bisect.bisect_right(bounds, lo)
+                if i and bounds[i - 1] > page:
+                    page = bounds[i - 1]
+                if done != None and page < done:
+                    page = done
+                while page < hi:
+                    stop = page - page % size + size if aligned else page + size
+                    i = bisect.bisect_right(bounds, page)
+                    if i < len(bounds) and bounds[i] < stop:
+                        stop = bounds[i]
+                    yield page, self.read(page, stop - page, fill)
+                    done = page = stop
+
+class UF2Converter:
+    # Conversion settings that used to be the appstartaddr/familyid module
+    # globals, so several images can be converted side by side from threads,
+    # process pools or a build server importing this module. Encoding only
+    # reads the settings and may share one converter; decoding records the
+    # start address it finds in `base`, like the CLI reports it, so give
+    # each concurrent decode its own converter.
+    #
+    # `erased` is the value of erased flash (usually 0xFF). When set, chunks
+    # holding nothing else are left out of encoded UF2 files, except the
+    # first and last so start address and length survive, and gaps are
+    # filled with it when decoding instead of with zeros.
+    #
+    # With `md5` every block carries the MD5 of its payload (flag 0x4000),
+    # so bootloaders that support it can skip pages that already match;
+    # the payload then has to fit in front of it, in 452 bytes.
+    def __init__(self, base=0x2000, family=0x0, payload_size=256, erased=None, md5=False):
+        self.base = base
+        self.family = family
+        self.payload_size = payload_size
+        self.erased = erased
+        self.md5 = md5
+
+    def settings_tag(self):
+        # Everything besides the input that changes the encoded output
+        return "%x|%x|%d|%r|%d" % (self.base, self.family, self.payload_size, self.erased,
+                                   self.md5)
+
+    def block_flags(self):
+        flags = 0x0
+        if self.family:
+            flags |= 0x2000
+        if self.md5:
+            flags |= 0x4000
+        return flags
+
+    def pack_md5(self, outp, blockptr, addr, datalen=None):
+        # Checksums the whole zero-padded payload, which is what gets flashed
+        import hashlib
+        datalen = datalen or self.payload_size
+        data = memoryview(outp)[blockptr + 32:blockptr + 32 + datalen]
+        UF2_MD5.pack_into(outp, blockptr + UF2_MD5_OFFSET, addr, datalen,
+                          hashlib.md5(data).digest())
+
+    def encode_block(self, outp, blockptr, addr, payload, blockno, numblocks, datalen=None):
+        # `outp` must be zeroed past the payload, as from bytearray(n); the
+        # payload is zero-padded to `datalen`, by default the payload size
+        datalen = datalen or self.payload_size
+        UF2_HEADER.pack_into(outp, blockptr,
+            UF2_MAGIC_START0, UF2_MAGIC_START1,
+            self.block_flags(), addr, datalen, blockno, numblocks, self.family)
+        outp[blockptr + 32:blockptr + 32 + len(payload)] = payload
+        if self.md5:
+            self.pack_md5(outp, blockptr, addr, datalen)
+        UF2_FOOTER.pack_into(outp, blockptr + 512 - 4, UF2_MAGIC_END)
+
+    def kept_chunks(self, src, pos, total):
+        # Offsets of the payload-sized chunks of `src`, found at offset `pos`
+        # of a `total` byte image, that need a block
+        size = self.payload_size
+        offsets = range(0, len(src), size)
+        if self.erased == None:
+            return offsets
+        erased = bytes([self.erased]) * size
+        last = total - 1 - (total - 1) % size
+        return [ptr for ptr in offsets
+                if pos + ptr == 0 or pos + ptr == last
+                or src[ptr:ptr + size] != erased[:len(src) - ptr]]
+
+    def encode_blocks(self, outp, src, addr, blockno, numblocks, offsets=None):
+        # Fill the zeroed `outp` with one 512-byte block per payload of
+        # `src` (or per offset in `offsets`); the zero fill doubles as chunk
+        # and data padding, so each block only needs its header, payload
+        # and end magic.
+        dst = memoryview(outp)
+        flags = self.block_flags()
+        size = self.payload_size
+        if offsets == None:
+            offsets = range(0, len(src), size)
+        for i, ptr in enumerate(offsets):
+            chunk = src[ptr:ptr + size]
+            blockptr = 512 * i
+            UF2_HEADER.pack_into(outp, blockptr,
+                UF2_MAGIC_START0, UF2_MAGIC_START1,
+                flags, addr + ptr, size, blockno + i, numblocks, self.family)
+            dst[blockptr + 32:blockptr + 32 + len(chunk)] = chunk
+            if self.md5:
+                self.pack_md5(outp, blockptr, addr + ptr)
+            UF2_FOOTER.pack_into(outp, blockptr + 512 - 4, UF2_MAGIC_END)
+
+    def to_uf2(self, file_content):
+        src = memoryview(file_content)
+        offsets = self.kept_chunks(src, 0, len(src))
+        numblocks = len(offsets)
+        outp = bytearray(numblocks * 512)
+        self.encode_blocks(outp, src, self.base, 0, numblocks, offsets)
+        return outp
+
+    def iter_uf2_blocks(self, reader, size=None):
+        """Encode a binary stream to UF2, yielding runs of whole 512-byte blocks.
+
+        numBlocks has to be known up front, so `size` defaults to the remaining
+        length of `reader`, which must then be a regular file.
+        """
+        if size is None:
+            size = os.fstat(reader.fileno()).st_size - reader.tell()
+        readsize = self.payload_size * STREAM_CHUNK_BLOCKS
+        if self.erased == None:
+            numblocks = (size + self.payload_size - 1) // self.payload_size
+        else:
+            # Which chunks are erased is only known after reading them all
+            start = reader.tell()
+            numblocks = 0
+            for pos in range(0, size, readsize):
+                chunk = read_full(reader, min(readsize, size - pos))
+                numblocks += len(self.kept_chunks(memoryview(chunk), pos, size))
+            reader.seek(start)
+        blockno = 0
+        pos = 0
+        while pos < size:
+            chunk = read_full(reader, min(readsize, size - pos))
+            if not chunk:
+                raise ValueError("Input ended after %d of %d bytes" % (pos, size))
+            src = memoryview(chunk)
+            offsets = self.kept_chunks(src, pos, size)
+            outp = bytearray(512 * len(offsets))
+            self.encode_blocks(outp, src, self.base + pos, blockno, numblocks, offsets)
+            blockno += len(offsets)
+            pos += len(chunk)
+            if outp:
+                yield outp
+
+    def contiguous_payload(self, view, numblocks):
+        # Fast path for the usual file: every block flashable and without
+        # MD5, with the same flags, family and payload size, and each
+        # payload continuing the one before. The header words are checked a
+        # column at a time through strided views and the payloads copied
+        # into one preallocated buffer. Returns (payload, flags, family),
+        # or None when the file needs the general decoder.
+        if sys.byteorder != "little" or not view.c_contiguous:
+            return None
+        words = view[:numblocks * 512].cast("I")
+        magic0, magic1, flags, base, datalen, _, _, family = words[:8]
+        if magic0 != UF2_MAGIC_START0 or magic1 != UF2_MAGIC_START1 or flags & 0x4001 or \
+           not 0 < datalen <= UF2_MAX_PAYLOAD:
+            return None
+        if not flags & 0x2000:
+            family = 0x0
+        if self.family != 0x0 and self.family != family:
+            return None
+        for column, value in ((0, magic0), (1, magic1), (2, flags), (4, datalen)):
+            if words[column::128].tolist().count(value) != numblocks:
+                return None
+        if family and words[7::128].tolist().count(family) != numblocks:
+            return None
+        if words[3::128].tolist() != list(range(base, base + numblocks * datalen, datalen)):
+            return None
+        outp = bytearray(numblocks * datalen)
+        pos = 0
+        for ptr in range(32, numblocks * 512, 512):
+            outp[pos:pos + datalen] = view[ptr:ptr + datalen]
+            pos += datalen
+        self.base = base
+        return outp, flags, family
+
+    def print_header_info(self, log, families_found, all_flags_same, flags):
+        print("--- UF2 File Header Info ---", file=log)
+        families = uf2families.load()
+        for family_hex in families_found.keys():
+            family_short_name = families.name_of(family_hex)
+            print("Family ID is {:s}, hex value is 0x{:08x}".format(family_short_name,family_hex), file=log)
+            print("Target Address is 0x{:08x}".format(families_found[family_hex]), file=log)
+        if all_flags_same:
+            print("All block flag values consistent, 0x{:04x}".format(flags or 0), file=log)
+        else:
+            print("Flags were not all the same", file=log)
+        print("----------------------------", file=log)
+
+    def from_uf2(self, buf, log=None):
+        # Accepts bytes, a memoryview or an mmap; payloads are copied straight
+        # from it into one preallocated output buffer. The header summary is
+        # printed to `log` when one is given.
+        familyid = self.family
+        view = memoryview(buf)
+        numblocks = len(view) // 512
+        fast = self.contiguous_payload(view, numblocks) if numblocks else None
+        if fast != None:
+            outp, flags, family = fast
+            if log:
+                self.print_header_info(log, {family: self.base} if family else {}, True, flags)
+            return outp
+        curraddr = None
+        currfamilyid = None
+        families_found = {}
+        prev_flag = None
+        all_flags_same = True
+        # First pass: headers only, collecting the kept payloads
+        image = SparseImage()
+        mixed = False
+        md5ptrs = array.array("Q")
+        ptr = -512
+        for hd in UF2_BLOCK.iter_unpack(view[:numblocks * 512]):
+            ptr += 512
+            if hd[0] != UF2_MAGIC_START0 or hd[1] != UF2_MAGIC_START1:
+                if log:
+                    print("Skipping block at %d; bad magic" % ptr, file=log)
+                continue
+            if hd[2] & 1:
+                # NO-flash flag set; skip block
+                continue
+            datalen = hd[4]
+            if datalen > UF2_MAX_PAYLOAD:
+                raise ValueError("Invalid UF2 data size at %d" % ptr)
+            if hd[2] & 0x4000:
+                md5ptrs.append(ptr)
+            newaddr = hd[3]
+            if (hd[2] & 0x2000) and (currfamilyid == None):
+                currfamilyid = hd[7]
+            if curraddr == None or ((hd[2] & 0x2000) and hd[7] != currfamilyid):
+                currfamilyid = hd[7]
+                curraddr = newaddr
+                if familyid == 0x0 or familyid == hd[7]:
+                    self.base = newaddr
+            padding = newaddr - curraddr
+            if padding < 0:
+                raise ValueError("Block out of order at %d" % ptr)
+            if padding > 10*1024*1024:
+                raise ValueError("More than 10M of padding needed at %d" % ptr)
+            if padding % 4 != 0:
+                raise ValueError("Non-word padding size at %d" % ptr)
+            if (hd[2] & 0x2000) and families_found and hd[7] not in families_found:
+                # Without a family selection the output is dropped below
+                mixed = True
+            if (familyid == 0x0 and not mixed) or ((hd[2] & 0x2000) and familyid == hd[7]):
+                try:
+                    image.add(newaddr, view[ptr + 32:ptr + 32 + datalen])
+                except ValueError:
+                    raise ValueError("Block overlaps earlier data at %d" % ptr)
+            curraddr = newaddr + datalen
+            if hd[2] & 0x2000:
+                if hd[7] in families_found.keys():
+                    if families_found[hd[7]] > newaddr:
+                        families_found[hd[7]] = newaddr
+                else:
+                    families_found[hd[7]] = newaddr
+            if prev_flag == None:
+                prev_flag = hd[2]
+            if prev_flag != hd[2]:
+                all_flags_same = False
+        if numblocks:
+            if log:
+                self.print_header_info(log, families_found, all_flags_same, prev_flag)
+            if len(families_found) > 1 and familyid == 0x0:
+                if log:
+                    print("Multiple families found; select one with --family, or use --split",
+                          file=log)
+                self.base = 0x0
+                return bytearray()
+        for ptr in md5ptrs:
+            if not md5_matches(view[ptr:ptr + 512]):
+                raise ValueError("MD5 checksum mismatch at %d" % ptr)
+        if len(image.segments) == 1:
+            # Contiguous, the usual case: the segment already is the image
+            return image.segments[0]
+        if len(image.segments) > 1 and self.erased == None and log:
+            print(GAP_WARNING, file=log)
+        return image.tobytes(self.erased or 0)
+
+    def split_uf2(self, buf):
+        # Decodes every block once and sorts payloads by family: family ID
+        # (0 for blocks without one) -> SparseImage of that family's data
+        view = memoryview(buf)
+        images = {}
+        ptr = -512
+        for hd in UF2_BLOCK.iter_unpack(view[:len(view) // 512 * 512]):
+            ptr += 512
+            if hd[0] != UF2_MAGIC_START0 or hd[1] != UF2_MAGIC_START1 or hd[2] & 1:
+                continue
+            datalen = hd[4]
+            if datalen > UF2_MAX_PAYLOAD:
+                raise ValueError("Invalid UF2 data size at %d" % ptr)
+            if hd[2] & 0x4000 and not md5_matches(view[ptr:ptr + 512]):
+                raise ValueError("MD5 checksum mismatch at %d" % ptr)
+            family = hd[7] if hd[2] & 0x2000 else 0x0
+            image = images.setdefault(family, SparseImage())
+            if image.segments and hd[3] - image.end > 10*1024*1024:
+                raise ValueError("More than 10M of padding needed at %d" % ptr)
+            try:
+                image.add(hd[3], view[ptr + 32:ptr + 32 + datalen])
+            except ValueError:
+                raise ValueError("Block overlaps earlier data at %d" % ptr)
+        return images
+
+    def iter_payload(self, reader):
+        """Decode a UF2 stream, yielding the flash image in bounded chunks.
+
+        Follows the rules of from_uf2, except that a second family without
+        a family selection is an error, as the output of the first one has
+        already been handed out.
+        """
+        familyid = self.family
+        curraddr = None
+        currfamilyid = None
+        warned = False
+        ptr = 0
+        while True:
+            chunk = read_full(reader, 512 * STREAM_CHUNK_BLOCKS)
+            if len(chunk) < 512:
+                break
+            view = memoryview(chunk)
+            outp = bytearray()
+            for blockptr in range(0, len(chunk) - 511, 512):
+                hd = UF2_HEADER.unpack_from(chunk, blockptr)
+                if hd[0] != UF2_MAGIC_START0 or hd[1] != UF2_MAGIC_START1:
+                    print("Skipping block at %d; bad magic" % (ptr + blockptr),
+                          file=sys.stderr)
+                    continue
+                if hd[2] & 1:
+                    # NO-flash flag set; skip block
+                    continue
+                datalen = hd[4]
+                if datalen > UF2_MAX_PAYLOAD:
+                    raise ValueError("Invalid UF2 data size at %d" % (ptr + blockptr))
+                if hd[2] & 0x4000 and not md5_matches(view[blockptr:blockptr + 512]):
+                    raise ValueError("MD5 checksum mismatch at %d" % (ptr + blockptr))
+                newaddr = hd[3]
+                if (hd[2] & 0x2000) and currfamilyid == None:
+                    currfamilyid = hd[7]
+                if curraddr == None or ((hd[2] & 0x2000) and hd[7] != currfamilyid):
+                    if curraddr != None and familyid == 0x0:
+                        raise ValueError("Multiple families found at %d; select one with --family"
+                                         % (ptr + blockptr))
+                    currfamilyid = hd[7]
+                    curraddr = newaddr
+                    if familyid == 0x0 or familyid == hd[7]:
+                        self.base = newaddr
+                if not (familyid == 0x0 or ((hd[2] & 0x2000) and familyid == hd[7])):
+                    curraddr = newaddr + datalen
+                    continue
+                padding = newaddr - curraddr
+                if padding < 0:
+                    raise ValueError("Block out of order at %d" % (ptr + blockptr))
+                if padding > 10*1024*1024:
+                    raise ValueError("More than 10M of padding needed at %d" % (ptr + blockptr))
+                if padding % 4 != 0:
+                    raise ValueError("Non-word padding size at %d" % (ptr + blockptr))
+                if padding and self.erased == None and not warned:
+                    print(GAP_WARNING, file=sys.stderr)
+                    warned = True
+                if padding:
+                    # Flush first so large gaps never sit in memory twice
+                    if outp:
+                        yield outp
+                        outp = bytearray()
+                    while padding > 0:
+                        n = min(padding, 512 * STREAM_CHUNK_BLOCKS)
+                        yield bytes([self.erased or 0]) * n
+                        padding -= n
+                outp += view[blockptr + 32:blockptr + 32 + datalen]
+                curraddr = newaddr + datalen
+            ptr += len(chunk)
+            if outp:
+                yield outp
+
+    def from_image(self, image, bounds=()):
+        # One block per page holding data (see SparseImage.pages), gaps
+        # within a page left as erased flash (0xFF)
+        pages = list(image.pages(self.payload_size, 0xFF, bounds))
+        outp = bytearray(len(pages) * 512)
+        for blockno, (addr, data) in enumerate(pages):
+            self.encode_block(outp, 512 * blockno, addr, data, blockno, len(pages), len(data))
+        return outp
+
+    def from_hex(self, buf):
+        image, self.base = read_hex(buf)
+        return self.from_image(image)
+
+    def from_elf(self, buf):
+        # ESP32 ELFs load into RAM and memory-mapped cache windows; their
+        # flash image is what esptool elf2image makes, so convert that .bin
+        name = uf2families.load().name_of(self.family)
+        if name.startswith("ESP"):
+            raise ValueError("%s ELF files do not describe the flash contents; "
+                             "convert the .bin made by esptool instead" % name)
+        image = read_elf(buf)
+        self.base = image.start
+        return self.from_image(image)
+
+
+def md5_matches(block):
+    # False when a flag 0x4000 block's checksummed region lies within its
+    # own payload and does not match it; regions elsewhere in flash cannot
+    # be checked from the file.
+    import hashlib
+    addr, datalen = UF2_HEADER.unpack_from(block)[3:5]
+    start, length, digest = UF2_MD5.unpack_from(block, UF2_MD5_OFFSET)
+    if datalen > UF2_MAX_MD5_PAYLOAD or start < addr or start + length > addr + datalen:
+        return True
+    return hashlib.md5(block[32 + start - addr:32 + start - addr + length]).digest() == digest
+
+def _md5_problems(buf, numblocks):
+    overlap = []
+    mismatch = []
+    for i, hd in enumerate(UF2_BLOCK.iter_unpack(buf[:numblocks * 512])):
+        if hd[0] != UF2_MAGIC_START0 or hd[1] != UF2_MAGIC_START1 or not hd[2] & 0x4000:
+            continue
+        if hd[4] > UF2_MAX_MD5_PAYLOAD:
+            overlap.append(i)
+        elif not md5_matches(buf[512 * i:512 * i + 512]):
+            mismatch.append(i)
+    return [("Payload overlaps MD5 checksum", overlap), ("MD5 checksum mismatch", mismatch)]
+
+def _uf2_problems_numpy(np, buf, numblocks):
+    blocks = np.frombuffer(buf, dtype=np.dtype([
+        ("magic0", "<u4"), ("magic1", "<u4"), ("flags", "<u4"), ("addr", "<u4"),
+        ("datalen", "<u4"), ("blockno", "<u4"), ("numblocks", "<u4"),
+        ("family", "<u4"), ("data", "V476"), ("magicend", "<u4")]), count=numblocks)
+    problems = []
+    bad_magic = (blocks["magic0"] != UF2_MAGIC_START0) | (blocks["magic1"] != UF2_MAGIC_START1)
+    problems.append(("Bad start magic", np.flatnonzero(bad_magic)))
+    problems.append(("Bad end magic", np.flatnonzero(blocks["magicend"] != UF2_MAGIC_END)))
+    # Everything below only looks at blocks that are recognisably UF2
+    idx = np.flatnonzero(~bad_magic)
+    b = blocks[idx]
+    problems.append(("Payload size over 476", idx[b["datalen"] > UF2_MAX_PAYLOAD]))
+    problems.append(("blockNo not below numBlocks", idx[b["blockno"] >= b["numblocks"]]))
+    blockno = b["blockno"].astype(np.int64)
+    nblocks = b["numblocks"].astype(np.int64)
+    restart = blockno[1:] == 0
+    step_ok = blockno[1:] == blockno[:-1] + 1
+    out_of_seq = np.flatnonzero(~step_ok & ~restart) + 1
+    if len(b) and blockno[0] != 0:
+        out_of_seq = np.concatenate(([0], out_of_seq))
+    problems.append(("blockNo out of sequence", idx[out_of_seq]))
+    changed = np.flatnonzero(~restart & (nblocks[1:] != nblocks[:-1])) + 1
+    problems.append(("numBlocks changes within a sequence", idx[changed]))
+    ends = np.flatnonzero(restart)
+    if len(b):
+        ends = np.concatenate((ends, [len(b) - 1]))
+    short = ends[blockno[ends] != nblocks[ends] - 1]
+    problems.append(("Sequence ends before numBlocks", idx[short]))
+    has_family = (b["flags"] & 0x2000) != 0
+    key = np.where(has_family, b["family"].astype(np.int64), -1)
+    order = np.argsort(key, kind="stable")
+    addr = b["addr"].astype(np.int64)[order]
+    end = addr + b["datalen"].astype(np.int64)[order]
+    same = key[order][1:] == key[order][:-1]
+    backwards = order[1:][same & (addr[1:] < end[:-1])]
+    problems.append(("Target address not above previous block of its family",
+                     idx[np.sort(backwards)]))
+    if has_family.any() and not has_family.all():
+        problems.append(("Family ID flag missing", idx[~has_family]))
+    mix = {}
+    for family, flags in zip(key.tolist(), b["flags"].tolist()):
+        mix[(family, flags)] = mix.get((family, flags), 0) + 1
+    return [(msg, found.tolist()) for msg, found in problems], mix
+
+def _uf2_problems_python(buf, numblocks):
+    problems = dict((msg, []) for msg in (
+        "Bad start magic", "Bad end magic", "Payload size over 476",
+        "blockNo not below numBlocks", "blockNo out of sequence",
+        "numBlocks changes within a sequence", "Sequence ends before numBlocks",
+        "Target address not above previous block of its family",
+        "Family ID flag missing"))
+    mix = {}
+    prev = None
+    prev_end = {}
+    with_family = []
+    without_family = []
+    for i, hd in enumerate(UF2_BLOCK_FULL.iter_unpack(buf[:numblocks * 512])):
+        if hd[8] != UF2_MAGIC_END:
+            problems["Bad end magic"].append(i)
+        if hd[0] != UF2_MAGIC_START0 or hd[1] != UF2_MAGIC_START1:
+            problems["Bad start magic"].append(i)
+            continue
+        flags, addr, datalen, blockno, nblocks = hd[2], hd[3], hd[4], hd[5], hd[6]
+        if datalen > UF2_MAX_PAYLOAD:
+            problems["Payload size over 476"].append(i)
+        if blockno >= nblocks:
+            problems["blockNo not below numBlocks"].append(i)
+        if prev == None:
+            if blockno != 0:
+                problems["blockNo out of sequence"].append(i)
+        elif blockno == 0:
+            if prev[1] != prev[2] - 1:
+                problems["Sequence ends before numBlocks"].append(prev[0])
+        else:
+            if blockno != prev[1] + 1:
+                problems["blockNo out of sequence"].append(i)
+            if nblocks != prev[2]:
+                problems["numBlocks changes within a sequence"].append(i)
+        prev = (i, blockno, nblocks)
+        key = hd[7] if flags & 0x2000 else -1
+        (with_family if flags & 0x2000 else without_family).append(i)
+        if key in prev_end and addr < prev_end[key]:
+            problems["Target address not above previous block of its family"].append(i)
+        prev_end[key] = addr + datalen
+        mix[(key, flags)] = mix.get((key, flags), 0) + 1
+    if prev != None and prev[1] != prev[2] - 1:
+        problems["Sequence ends before numBlocks"].append(prev[0])
+    if with_family and without_family:
+        problems["Family ID flag missing"] = without_family
+    return list(problems.items()), mix
+
+def validate_uf2(buf):
+    # Checks every block of a UF2 image at once and returns a list of
+    # problem descriptions (empty when the file is sound) plus summary lines.
+    # Vectorised with NumPy when available, in plain Python otherwise.
+    view = memoryview(buf)
+    numblocks = len(view) // 512
+    try:
+        import numpy as np
+    except ImportError:
+        np = None
+    if np != None:
+        found, mix = _uf2_problems_numpy(np, view, numblocks)
+    else:
+        found, mix = _uf2_problems_python(view, numblocks)
+    found += _md5_problems(view, numblocks)
+    problems = []
+    if len(view) % 512:
+        problems.append("File size %d is not a multiple of 512" % len(view))
+    for msg, blocks in found:
+        if not blocks:
+            continue
+        where = ", ".join("%d" % blockidx for blockidx in blocks[:8])
+        if len(blocks) > 8:
+            where += ", ... %d more" % (len(blocks) - 8)
+        problems.append("%s: %d block(s) at index %s" % (msg, len(blocks), where))
+    families = uf2families.load()
+    summary = []
+    for (family, flags), count in sorted(mix.items()):
+        name = "no family ID"
+        if family != -1:
+            name = "family 0x%08x" % family
+            if family in families.by_id:
+                name += " (%s)" % families.by_id[family]
+        summary.append("%d block(s) with %s, flags 0x%04x" % (count, name, flags))
+    return problems, summary
+
+class UF2Index:
+    # Target address ranges of a UF2 file from one header-only pass, kept
+    # in compact arrays sorted by address so read() can binary search them
+    # instead of decoding the whole image.
+    CACHE_VERSION = 1
+    FIELDS = ("addrs", "datalens", "flags", "families", "blocknos", "offsets")
+
+    def __init__(self, path, cachedir=None):
+        self.path = os.path.abspath(path)
+        st = os.stat(self.path)
+        # Cached indexes are only trusted for the same size and mtime
+        self.key = (st.st_size, st.st_mtime_ns)
+        cachefile = None
+        if cachedir:
+            import hashlib
+            name = hashlib.sha1(self.path.encode("utf-8")).hexdigest() + ".idx"
+            cachefile = os.path.join(cachedir, name)
+            if self._load(cachefile):
+                return
+        self._scan()
+        if cachefile:
+            self._save(cachefile)
+
+    def _scan(self):
+        addrs = array.array("I")
+        datalens = array.array("H")
+        flags = array.array("I")
+        families = array.array("I")
+        blocknos = array.array("I")
+        offsets = array.array("Q")
+        numblocks = self.key[0] // 512
+        if numblocks:
+            with open(self.path, "rb") as f, \
+                    mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m, \
+                    memoryview(m) as view:
+                ptr = -512
+                for hd in UF2_BLOCK.iter_unpack(view[:numblocks * 512]):
+                    ptr += 512
+                    if hd[0] != UF2_MAGIC_START0 or hd[1] != UF2_MAGIC_START1 or hd[4] > UF2_MAX_PAYLOAD:
+                        continue
+                    addrs.append(hd[3])
+                    datalens.append(hd[4])
+                    flags.append(hd[2])
+                    families.append(hd[7])
+                    blocknos.append(hd[5])
+                    offsets.append(ptr)
+        columns = [addrs, datalens, flags, families, blocknos, offsets]
+        if any(addrs[i] > addrs[i + 1] for i in range(len(addrs) - 1)):
+            order = sorted(range(len(addrs)), key=addrs.__getitem__)
+            columns = [array.array(c.typecode, [c[i] for i in order]) for c in columns]
+        for name, column in zip(self.FIELDS, columns):
+            setattr(self, name, column)
+
+    def _load(self, cachefile):
+        try:
+            with open(cachefile, "rb") as f:
+                version, key, columns = pickle.load(f)
+        except (OSError, EOFError, ValueError, pickle.UnpicklingError):
+            return False
+        if version != self.CACHE_VERSION or key != self.key:
+            return False
+        for name, column in zip(self.FIELDS, columns):
+            setattr(self, name, column)
+        return True
+
+    def _save(self, cachefile):
+        columns = [getattr(self, name) for name in self.FIELDS]
+        uf2cache.save_pickle(cachefile, (self.CACHE_VERSION, self.key, columns))
+
+    def __len__(self):
+        return len(self.addrs)
+
+    def _wanted(self, i, family):
+        if self.flags[i] & 1:
+            # NO-flash flag set
+            return False
+        return family == None or ((self.flags[i] & 0x2000) and self.families[i] == family)
+
+    def ranges(self, family=None):
+        # Merged [start, end) target address ranges of flashable blocks
+        out = []
+        for i in range(len(self.addrs)):
+            if not self._wanted(i, family):
+                continue
+            start, end = self.addrs[i], self.addrs[i] + self.datalens[i]
+            if out and start <= out[-1][1]:
+                out[-1][1] = max(out[-1][1], end)
+            else:
+                out.append([start, end])
+        return [tuple(r) for r in out]
+
+    def read(self, addr, length, family=None):
+        # Bytes not covered by any block read as zero, as in convert_from_uf2
+        outp = bytearray(length)
+        dst = memoryview(outp)
+        end = addr + length
+        # No block starting 476 bytes or more below `addr` can reach it
+        first = bisect.bisect_right(self.addrs, addr - UF2_MAX_PAYLOAD)
+        last = bisect.bisect_left(self.addrs, end)
+        with open(self.path, "rb") as f:
+            for i in range(first, last):
+                if not self._wanted(i, family):
+                    continue
+                lo = max(addr, self.addrs[i])
+                hi = min(end, self.addrs[i] + self.datalens[i])
+                if lo < hi:
+                    f.seek(self.offsets[i] + 32 + lo - self.addrs[i])
+                    f.readinto(dst[lo - addr:hi - addr])
+        return bytes(outp)
+
+class UF2Reader:
+    # Random access to the flash contents of a UF2 file that reads just the
+    # blocks asked for, by computing where they are. That holds for the
+    # usual layout of equal, contiguous blocks in address order, as written
+    # here and by bootloaders for CURRENT.UF2; for anything else it falls
+    # back to a UF2Index. Bytes outside the file read as zero; ranges()
+    # tells them apart.
+    def __init__(self, path, family=None):
+        self.path = path
+        self.family = family
+        self._index = None
+        self._ranges = None
+        with open(path, "rb") as f:
+            head = read_full(f, 32)
+            self.numblocks = os.fstat(f.fileno()).st_size // 512
+            f.seek(512 * max(self.numblocks - 1, 0))
+            tail = read_full(f, 32)
+        if len(head) < 32 or not is_uf2(head):
+            raise ValueError("%s is not a UF2 file" % path)
+        hd = UF2_HEADER.unpack(head)
+        self.start = hd[3]
+        self.payload_size = max(hd[4], 1)
+        # A gap anywhere shows up as a last block past where it should be
+        if len(tail) < 32 or \
+           UF2_HEADER.unpack(tail)[3] != self.start + (self.numblocks - 1) * self.payload_size:
+            self._use_index()
+
+    def _use_index(self):
+        self._index = UF2Index(self.path, uf2cache.user_cache_dir())
+        self._ranges = None
+
+    def ranges(self):
+        # Merged [start, end) target ranges the blocks cover
+        if self._index == None:
+            return [(self.start, self.start + self.numblocks * self.payload_size)]
+        if self._ranges == None:
+            self._ranges = self._index.ranges(self.family)
+        return self._ranges
+
+    def read(self, addr, length):
+        if self._index != None:
+            return self._index.read(addr, length, self.family)
+        outp = bytearray(length)
+        end = addr + length
+        pos = max(addr, self.start)
+        first = (pos - self.start) // self.payload_size
+        last = min((end - 1 - self.start) // self.payload_size + 1, self.numblocks)
+        if pos >= end or first >= last:
+            return outp
+        # One read for the whole run of blocks
+        with open(self.path, "rb") as f:
+            f.seek(512 * first)
+            blocks = read_full(f, 512 * (last - first))
+        for i in range(first, last):
+            ptr = 512 * (i - first)
+            hd = UF2_HEADER.unpack_from(blocks, ptr) if ptr + 512 <= len(blocks) else None
+            if hd == None or hd[0] != UF2_MAGIC_START0 or hd[1] != UF2_MAGIC_START1 or \
+               hd[2] & 1 or hd[3] != self.start + i * self.payload_size or \
+               hd[4] != self.payload_size or (self.family != None and hd[7] != self.family):
+                self._use_index()
+                return self._index.read(addr, length, self.family)
+            n = min(end, hd[3] + hd[4]) - pos
+            outp[pos - addr:pos - addr + n] = blocks[ptr + 32 + pos - hd[3]:ptr + 32 + pos - hd[3] + n]
+            pos += n
+        return outp
+
+class ConversionCache:
+    # Content-addressed store of converted outputs, keyed by a hash of the
+    # input bytes plus every setting that changes the output, and bounded
+    # in size by evicting the least recently used entries. Hits are
+    # hardlinked to the destination where possible, so replace outputs
+    # (remove, then write) rather than rewriting them in place.
+    def __init__(self, path, max_bytes=256 * 1024 * 1024):
+        self.path = path
+        self.max_bytes = max_bytes
+
+    def key(self, inputname, conv, fmt):
+        import hashlib
+        h = hashlib.sha256()
+        with open(inputname, "rb") as f:
+            for chunk in iter(lambda: f.read(1024 * 1024), b""):
+                h.update(chunk)
+        h.update(("|%s|%s" % (conv.settings_tag(), fmt)).encode("utf-8"))
+        return h.hexdigest()
+
+    def _entry(self, key):
+        return os.path.join(self.path, key)
+
+    def fetch(self, key, dest):
+        entry = self._entry(key)
+        try:
+            # mtime doubles as the LRU timestamp
+            os.utime(entry)
+        except OSError:
+            return False
+        remove_file(dest)
+        try:
+            os.link(entry, dest)
+        except OSError:
+            import shutil
+            shutil.copyfile(entry, dest)
+        return True
+
+    def store(self, key, src):
+        # Failing to cache is not an error
+        import shutil
+        try:
+            with open(src, "rb") as f:
+                uf2cache.write_atomic(self._entry(key), lambda dst: shutil.copyfileobj(f, dst))
+            self.trim()
+        except OSError:
+            pass
+
+    def trim(self):
+        entries = []
+        for name in os.listdir(self.path):
+            if name.endswith(".tmp"):
+                continue
+            path = os.path.join(self.path, name)
+            st = os.stat(path)
+            entries.append((st.st_mtime, st.st_size, path))
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            os.remove(path)
+            total -= size
+
+def block_digests(buf):
+    # Target address -> (family, length, MD5) of the payload of every
+    # flashable block of the UF2 image `buf`, i.e. what flashing it writes
+    import hashlib
+    view = memoryview(buf)
+    digests = {}
+    ptr = -512
+    for hd in UF2_BLOCK.iter_unpack(view[:len(view) // 512 * 512]):
+        ptr += 512
+        if hd[0] != UF2_MAGIC_START0 or hd[1] != UF2_MAGIC_START1 or hd[2] & 1:
+            continue
+        datalen = min(hd[4], UF2_MAX_PAYLOAD)
+        family = hd[7] if hd[2] & 0x2000 else None
+        digests[hd[3]] = (family, datalen,
+                          hashlib.md5(view[ptr + 32:ptr + 32 + datalen]).digest())
+    return digests
+
+def delta_uf2(buf, previous):
+    # The flashable blocks of `buf` whose payload differs from `previous`
+    # (as returned by block_digests), renumbered as one sequence. With
+    # nothing changed the first block is kept, so the bootloader still
+    # sees a complete transfer and restarts the board.
+    view = memoryview(buf)
+    current = block_digests(view)
+    kept = []
+    first = None
+    ptr = -512
+    for hd in UF2_BLOCK.iter_unpack(view[:len(view) // 512 * 512]):
+        ptr += 512
+        if hd[0] != UF2_MAGIC_START0 or hd[1] != UF2_MAGIC_START1 or hd[2] & 1:
+            continue
+        if first == None:
+            first = ptr
+        if previous.get(hd[3]) != current[hd[3]]:
+            kept.append(ptr)
+    if not kept and first != None:
+        kept.append(first)
+    outp = bytearray(512 * len(kept))
+    for blockno, ptr in enumerate(kept):
+        outp[512 * blockno:512 * blockno + 512] = view[ptr:ptr + 512]
+        struct.pack_into(b"<II", outp, 512 * blockno + 20, blockno, len(kept))
+    return outp
+
+class BoardRecords:
+    # What each board was last flashed with, by board_key: the block digests
+    # of every UF2 sent to it (see block_digests), so --delta can leave out
+    # blocks the board already holds. Blocks overwrite the entries they
+    # overlap. Flashing by other means (esptool, another machine) makes a
+    # record stale; flash once without --delta to bring it up to date.
+    VERSION = 1
+
+    def __init__(self, path=None):
+        self.path = path or os.path.join(uf2cache.user_cache_dir(), "boards")
+
+    def _file(self, key):
+        import hashlib
+        return os.path.join(self.path, hashlib.sha1(key.encode("utf-8")).hexdigest() + ".pickle")
+
+    def load(self, key):
+        try:
+            with open(self._file(key), "rb") as f:
+                version, recorded_key, digests = pickle.load(f)
+        except (OSError, EOFError, ValueError, pickle.UnpicklingError):
+            return {}
+        if version != self.VERSION or recorded_key != key:
+            return {}
+        return digests
+
+    def forget(self, key):
+        try:
+            os.remove(self._file(key))
+        except OSError:
+            pass
+
+    def update(self, key, sent):
+        digests = self.load(key)
+        starts = sorted(sent)
+        for addr, (_, length, _) in list(digests.items()):
+            if addr in sent:
+                continue
+            # Drop entries partly overwritten by a block on another grid
+            i = bisect.bisect_left(starts, addr + length)
+            if i and starts[i - 1] + sent[starts[i - 1]][1] > addr:
+                del digests[addr]
+        digests.update(sent)
+        uf2cache.save_pickle(self._file(key), (self.VERSION, key, digests))
+
+class ArtifactStore:
+    # Content-addressed UF2 archive. Every distinct block payload is kept
+    # once in an append-only pack file, keyed by its SHA-256; an artifact
+    # is a manifest of its block headers plus pack offsets, named by the
+    # SHA-256 of the whole file and rebuilt byte for byte on demand. Storage
+    # grows with unique content, and diffing two stored artifacts compares
+    # pack offsets without touching any payload.
+    VERSION = 1
+    # Pack offset for a data area that is zero past the payload
+    ZERO = 0xFFFFFFFFFFFFFFFF
+
+    def __init__(self, path=None):
+        self.path = path or os.path.join(uf2cache.user_cache_dir(), "store")
+
+    def _file(self, *parts):
+        return os.path.join(self.path, *parts)
+
+    def _load_index(self):
+        # Payload SHA-256 -> pack offset, and artifact name -> ID, merged
+        # from the record every add appends to store.idx; plus where the
+        # last complete record ends, in case an add was cut short
+        chunks, names = {}, {}
+        end = 0
+        try:
+            f = open(self._file("store.idx"), "rb")
+        except FileNotFoundError:
+            return chunks, names, end
+        with f:
+            while True:
+                try:
+                    version, added, named = pickle.load(f)
+                except EOFError:
+                    break
+                except (pickle.UnpicklingError, ValueError):
+                    # Only an interrupted append leaves a torn record
+                    break
+                if version != self.VERSION:
+                    raise ValueError("%s is an artifact store of another version" % self.path)
+                chunks.update(added)
+                names.update(named)
+                end = f.tell()
+        return chunks, names, end
+
+    def _replace(self, name, obj):
+        uf2cache.write_atomic(self._file(name),
+                              lambda f: pickle.dump(obj, f, pickle.HIGHEST_PROTOCOL))
+
+    def add(self, filename, name=None):
+        # Stores `filename` under `name`, by default the path as given, and
+        # returns (artifact ID, number of payloads that were new, ID the
+        # name referred to before if that was another artifact)
+        import hashlib
+        with open(filename, "rb") as f:
+            buf = f.read()
+        artifact = hashlib.sha256(buf).hexdigest()
+        os.makedirs(self._file("manifests"), exist_ok=True)
+        with open(self._file("lock"), "w") as lock:
+            try:
+                import fcntl
+                fcntl.flock(lock, fcntl.LOCK_EX)
+            except ImportError:
+                pass
+            chunks, names, end = self._load_index()
+            added = {}
+            view = memoryview(buf)
+            numblocks = len(view) // 512
+            headers = array.array("I")
+            refs = array.array("Q")
+            new = 0
+            zero = bytes(UF2_MAX_PAYLOAD)
+            with open(self._file("payloads.pack"), "ab") as pack:
+                pos = pack.tell()
+                def put(data):
+                    nonlocal pos, new
+                    key = hashlib.sha256(data).digest()
+                    offset = chunks.get(key)
+                    if offset == None:
+                        offset = chunks[key] = added[key] = pos
+                        pack.write(data)
+                        pos += len(data)
+                        new += 1
+                    return offset
+                for hd in UF2_BLOCK_FULL.iter_unpack(view[:numblocks * 512]):
+                    ptr = 512 * (len(headers) // 9)
+                    headers.extend(hd)
+                    datalen = min(hd[4], UF2_MAX_PAYLOAD)
+                    refs.append(put(view[ptr + 32:ptr + 32 + datalen]))
+                    rest = view[ptr + 32 + datalen:ptr + 508]
+                    refs.append(self.ZERO if rest == zero[:len(rest)] else put(rest))
+                tail = put(view[numblocks * 512:])
+            import zlib
+            self._replace(os.path.join("manifests", artifact),
+                          (self.VERSION, len(view), zlib.compress(headers.tobytes()),
+                           zlib.compress(refs.tobytes()), tail))
+            name = name or os.path.normpath(filename)
+            replaced = names.get(name)
+            with open(self._file("store.idx"), "ab") as index:
+                index.truncate(end)
+                pickle.dump((self.VERSION, added, {name: artifact}), index,
+                            pickle.HIGHEST_PROTOCOL)
+        return artifact, new, replaced if replaced != artifact else None
+
+    def names(self):
+        return self._load_index()[1]
+
+    def packed_size(self):
+        try:
+            return os.path.getsize(self._file("payloads.pack"))
+        except FileNotFoundError:
+            return 0
+
+    def resolve(self, ref):
+        # Artifact ID for a name, the file name of a single stored path,
+        # a full ID or an unambiguous ID prefix
+        names = self.names()
+        if ref in names:
+            return names[ref]
+        matches = [name for name in names if os.path.basename(name) == ref]
+        if len(matches) > 1:
+            raise ValueError("%s matches %d stored names, e.g. %s; give the path" %
+                             (ref, len(matches), ", ".join(sorted(matches)[:3])))
+        if matches:
+            return names[matches[0]]
+        try:
+            found = [name for name in os.listdir(self._file("manifests")) if name.startswith(ref)]
+        except FileNotFoundError:
+            found = []
+        if len(found) != 1:
+            raise ValueError("No single artifact matches %s" % ref)
+        return found[0]
+
+    def _manifest(self, artifact):
+        import zlib
+        with open(self._file("manifests", artifact), "rb") as f:
+            version, size, headers, refs, tail = pickle.load(f)
+        if version != self.VERSION:
+            raise ValueError("%s is an artifact store of another version" % self.path)
+        return (size, array.array("I", zlib.decompress(headers)),
+                array.array("Q", zlib.decompress(refs)), tail)
+
+    def block_map(self, artifact):
+        # Like block_digests, with pack offsets standing in for the digests
+        size, headers, refs, _ = self._manifest(artifact)
+        blocks = {}
+        for i in range(len(headers) // 9):
+            hd = headers[9 * i:9 * i + 9]
+            if hd[0] != UF2_MAGIC_START0 or hd[1] != UF2_MAGIC_START1 or hd[2] & 1:
+                continue
+            blocks[hd[3]] = (hd[7] if hd[2] & 0x2000 else None, min(hd[4], UF2_MAX_PAYLOAD),
+                             refs[2 * i])
+        return blocks
+
+    def rebuild(self, artifact):
+        size, headers, refs, tail = self._manifest(artifact)
+        outp = bytearray(size)
+        with open(self._file("payloads.pack"), "rb") as f:
+            packsize = os.fstat(f.fileno()).st_size
+            pack = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) if packsize else b""
+            for i in range(len(headers) // 9):
+                hd = headers[9 * i:9 * i + 9]
+                ptr = 512 * i
+                UF2_BLOCK_FULL.pack_into(outp, ptr, *hd)
+                datalen = min(hd[4], UF2_MAX_PAYLOAD)
+                outp[ptr + 32:ptr + 32 + datalen] = pack[refs[2 * i]:refs[2 * i] + datalen]
+                if refs[2 * i + 1] != self.ZERO:
+                    rest = UF2_MAX_PAYLOAD - datalen
+                    outp[ptr + 32 + datalen:ptr + 508] = pack[refs[2 * i + 1]:refs[2 * i + 1] + rest]
+            taillen = size - 512 * (len(headers) // 9)
+            outp[size - taillen:] = pack[tail:tail + taillen]
+        return outp
+
+def diff_blocks(old, new):
+    # Compares two address -> (family, length, key) maps (block_digests or
+    # ArtifactStore.block_map) and returns merged [start, end, kind] ranges,
+    # kind being "changed", "removed" (only in old) or "added" (only in new)
+    ranges = []
+    for addr in sorted(set(old) | set(new)):
+        a, b = old.get(addr), new.get(addr)
+        if a == b:
+            continue
+        kind = "changed" if a and b else ("removed" if a else "added")
+        end = addr + (b or a)[1]
+        if ranges and ranges[-1][2] == kind and ranges[-1][1] == addr:
+            ranges[-1][1] = end
+        else:
+            ranges.append([addr, end, kind])
+    return ranges
+
+def write_carray(f, file_content, words=False):
+    # Emits one row at a time with a single %-format per row, so the cost
+    # is linear in the input and nothing but the current row is buffered.
+    size = len(file_content)
+    f.write("const unsigned long bindata_len = %d;\n" % size)
+    if words:
+        # Little-endian words, matching the byte order of the ESP32 targets,
+        # so `bindata` sees the original bytes at a quarter of the tokens.
+        padded = bytes(file_content) + bytes(-size % 4)
+        f.write("static const unsigned int bindata_words[] __attribute__((aligned(16))) = {")
+        wordvals = array.array("I", padded)
+        if sys.byteorder != "little":
+            wordvals.byteswap()
+        rowlen, fmt = 8, "0x%08x, "
+    else:
+        f.write("const unsigned char bindata[] __attribute__((aligned(16))) = {")
+        wordvals = file_content
+        rowlen, fmt = 16, "0x%02x, "
+    rowfmt = "\n" + fmt * rowlen
+    full = len(wordvals) - len(wordvals) % rowlen
+    for i in range(0, full, rowlen):
+        f.write(rowfmt % tuple(wordvals[i:i + rowlen]))
+    if full < len(wordvals):
+        f.write("\n" + fmt * (len(wordvals) - full) % tuple(wordvals[full:]))
+    f.write("\n};\n")
+    if words:
+        f.write("const unsigned char *const bindata = (const unsigned char *)bindata_words;\n")
+
+def convert_to_carray(file_content, words=False):
+    outp = io.StringIO()
+    write_carray(outp, file_content, words)
+    return bytes(outp.getvalue(), "utf-8")
+
+def write_incbin(name, inputname, size):
+    # The assembler pulls the binary in itself, so no conversion happens at
+    # all; the header next to it declares the same symbols as --carray.
+    header = os.path.splitext(name)[0] + ".h"
+    with open(name, "w", newline="") as f:
+        f.write('    .section .rodata.bindata, "a"\n'
+                "    .global bindata\n"
+                "    .global bindata_end\n"
+                "    .balign 16\n"
+                "bindata:\n"
+                '    .incbin "%s"\n'
+                "bindata_end:\n" % inputname.replace("\\", "/"))
+    with open(header, "w", newline="") as f:
+        f.write("extern const unsigned char bindata[] __attribute__((aligned(16)));\n"
+                "extern const unsigned char bindata_end[];\n"
+                "#define bindata_len ((unsigned long)(bindata_end - bindata))\n")
+    print("Wrote %s and %s for %d bytes of %s" % (name, header, size, inputname))
+
+def read_full(reader, size):
+    # Like reader.read(size), but never returns short before EOF; pipes and
+    # raw files are allowed to.
+    buf = reader.read(size)
+    while buf and len(buf) < size:
+        more = reader.read(size - len(buf))
+        if not more:
+            break
+        buf += more
+    return buf
+
+class Block:
+    def __init__(self, addr, default_data=0xFF, size=256):
+        self.addr = addr
+        self.bytes = bytearray([default_data]) * size
+
+    def encode(self, blockno, numblocks):
+        outp = bytearray(512)
+        conv = UF2Converter(appstartaddr, familyid, len(self.bytes))
+        conv.encode_block(outp, 0, self.addr, self.bytes, blockno, numblocks)
+        return bytes(outp)
+
+def read_elf(buf):
+    # The file contents of an ELF's PT_LOAD segments as a SparseImage at
+    # their physical (load) addresses; .bss and other zero-fill is not
+    # flashed. Accepts bytes or an mmap, 32 or 64 bit, either byte order.
+    if not is_elf(buf) or buf[4] not in (1, 2) or buf[5] not in (1, 2):
+        raise ValueError("Not a valid ELF file")
+    order = "<" if buf[5] == 1 else ">"
+    if buf[4] == 1:
+        phoff, = struct.unpack_from(order + "I", buf, 28)
+        phentsize, phnum = struct.unpack_from(order + "HH", buf, 42)
+        # p_type, p_offset, p_vaddr, p_paddr, p_filesz
+        phdr = struct.Struct(order + "IIIII")
+    else:
+        phoff, = struct.unpack_from(order + "Q", buf, 32)
+        phentsize, phnum = struct.unpack_from(order + "HH", buf, 54)
+        # p_type, p_flags, p_offset, p_vaddr, p_paddr, p_filesz
+        phdr = struct.Struct(order + "IIQQQQ")
+    view = memoryview(buf)
+    image = SparseImage()
+    for i in range(phnum):
+        ptr = phoff + i * phentsize
+        if ptr + phdr.size > len(view):
+            raise ValueError("ELF program header %d is past the end of the file" % i)
+        fields = phdr.unpack_from(buf, ptr)
+        ptype, offset, paddr, filesz = fields[0], fields[-4], fields[-2], fields[-1]
+        if ptype != 1 or filesz == 0:
+            continue
+        if offset + filesz > len(view):
+            raise ValueError("ELF segment %d is past the end of the file" % i)
+        try:
+            image.add(paddr, view[offset:offset + filesz])
+        except ValueError as e:
+            raise ValueError("ELF segment %d: %s" % (i, e))
+    if not image.segments:
+        raise ValueError("ELF file has no loadable data")
+    return image
+
+def read_hex(buf):
+    # Returns the data records of Intel HEX text as a SparseImage, plus the
+    # address of the first one.
+    image = SparseImage()
+    startaddr = None
+    upper = 0
+    for lineno, line in enumerate(buf.splitlines(), 1):
+        line = line.strip()
+        if not line.startswith(":"):
+            continue
+        try:
+            rec = bytes.fromhex(line[1:])
+        except ValueError:
+            raise ValueError("Malformed HEX record on line %d" % lineno)
+        if len(rec) < 5 or len(rec) != rec[0] + 5:
+            raise ValueError("Bad HEX record length on line %d" % lineno)
+        if sum(rec) & 0xff:
+            raise ValueError("Bad HEX checksum on line %d" % lineno)
+        tp = rec[3]
+        if tp == 4:
+            upper = ((rec[4] << 8) | rec[5]) << 16
+        elif tp == 2:
+            upper = ((rec[4] << 8) | rec[5]) << 4
+        elif tp == 1:
+            break
+        elif tp == 0:
+            addr = upper + ((rec[1] << 8) | rec[2])
+            if startaddr == None:
+                startaddr = addr
+            try:
+                image.add(addr, memoryview(rec)[4:-1])
+            except ValueError as e:
+                raise ValueError("%s on line %d" % (e, lineno))
+    return image, startaddr
+
+def parse_hex(buf, pagesize=256):
+    # Returns a sparse map of page-aligned address -> Block, plus the
+    # address of the first data record.
+    image, startaddr = read_hex(buf)
+    blocks = {}
+    for addr, data in image.pages(pagesize, 0xFF):
+        blocks[addr] = Block(addr, size=pagesize)
+        blocks[addr].bytes[:] = data
+    return blocks, startaddr
+
+# Module-level API on top of UF2Converter, for scripts that still set
+# appstartaddr and familyid directly.
+
+def convert_from_uf2(buf, erased=None):
+    global appstartaddr
+    conv = UF2Converter(appstartaddr, familyid, erased=erased)
+    outp = conv.from_uf2(buf, sys.stdout)
+    appstartaddr = conv.base
+    return outp
+
+def convert_to_uf2(file_content, erased=None):
+    return UF2Converter(appstartaddr, familyid, erased=erased).to_uf2(file_content)
+
+def convert_from_hex_to_uf2(buf):
+    global appstartaddr
+    conv = UF2Converter(appstartaddr, familyid)
+    outp = conv.from_hex(buf)
+    appstartaddr = conv.base
+    return outp
+
+def iter_uf2_blocks(reader, size=None, erased=None):
+    return UF2Converter(appstartaddr, familyid, erased=erased).iter_uf2_blocks(reader, size)
+
+def iter_payload(reader, erased=None):
+    global appstartaddr
+    conv = UF2Converter(appstartaddr, familyid, erased=erased)
+    for chunk in conv.iter_payload(reader):
+        appstartaddr = conv.base
+        yield chunk
+
+
+def to_str(b):
+    return b.decode("utf-8")
+
+def get_drives():
+    drives = []
+    if sys.platform == "win32":
+        import subprocess
+        r = subprocess.check_output(["wmic", "PATH", "Win32_LogicalDisk",
+                                     "get", "DeviceID,", "VolumeName,",
+                                     "FileSystem,", "DriveType"])
+        for line in to_str(r).split('\n'):
+            words = re.split(r'\s+', line)
+            if len(words) >= 3 and words[1] == "2" and words[2] == "FAT":
+                drives.append(words[0])
+    elif sys.platform == "linux" and os.path.exists(MOUNTINFO):
+        # Every mounted FAT file system, wherever the automounter put it
+        drives = fat_mounts()
+    else:
+        searchpaths = ["/mnt", "/media"]
+        if sys.platform == "darwin":
+            searchpaths = ["/Volumes"]
+        elif sys.platform == "linux":
+            searchpaths += ["/media/" + os.environ["USER"], "/run/media/" + os.environ["USER"]]
+            if "SUDO_USER" in os.environ.keys():
+                searchpaths += ["/media/" + os.environ["SUDO_USER"]]
+                searchpaths += ["/run/media/" + os.environ["SUDO_USER"]]
+
+        for rootpath in searchpaths:
+            if os.path.isdir(rootpath):
+                for d in os.listdir(rootpath):
+                    if os.path.isdir(os.path.join(rootpath, d)):
+                        drives.append(os.path.join(rootpath, d))
+
+    return list(filter(has_info, drives))
+
+
+def has_info(d):
+    try:
+        return os.path.isfile(d + INFO_FILE)
+    except:
+        return False
+
+
+def read_mounts(table=None):
+    # (mount point, fstype, source) per line of the mountinfo text `table`,
+    # read from MOUNTINFO by default
+    if table == None:
+        with open(MOUNTINFO) as f:
+            table = f.read()
+    mounts = []
+    for line in table.splitlines():
+        # ID parent major:minor root mountpoint options [optional...] - fstype source ...
+        fields = line.split()
+        sep = fields.index("-")
+        mounts.append((re.sub(r"\\([0-7]{3})", lambda m: chr(int(m.group(1), 8)), fields[4]),
+                       fields[sep + 1], fields[sep + 2]))
+    return mounts
+
+
+def fat_mounts(table=None):
+    return [mountpoint for mountpoint, fstype, _ in read_mounts(table) if fstype in FAT_FSTYPES]
+
+
+def wait_for_drives(boards=None):
+    drives = select_boards(get_drives(), boards)
+    if drives:
+        return drives
+    if sys.platform != "linux" or not os.path.exists(MOUNTINFO):
+        while len(drives) == 0:
+            sleep(0.1)
+            drives = select_boards(get_drives(), boards)
+        return drives
+    # The kernel flags mountinfo with POLLPRI/POLLERR whenever the mount
+    # table changes, so a new board is picked up as soon as it is mounted.
+    import select
+    # FAT file systems mounted before the wait (e.g. /boot/efi) are not
+    # boards on their way up; only ones that show up later are watched
+    known = set(fat_mounts())
+    appeared = {}
+    with open(MOUNTINFO) as f:
+        poller = select.poll()
+        poller.register(f, select.POLLPRI | select.POLLERR)
+        while True:
+            # Reading the table acknowledges the change; anything after
+            # this read wakes the next poll()
+            f.seek(0)
+            mounts = fat_mounts(f.read())
+            drives = select_boards(list(filter(has_info, mounts)), boards)
+            if drives:
+                return drives
+            now = time.monotonic()
+            appeared = dict((d, appeared.get(d, now)) for d in mounts if d not in known)
+            # A new FAT mount without INFO_UF2.TXT may still be populating;
+            # re-check it at the old polling rate for a while, otherwise
+            # just sleep until the mount table changes
+            settling = any(now - since < MOUNT_SETTLE for since in appeared.values())
+            poller.poll(100 if settling else 1000)
+
+
+# Board-ID per INFO_UF2.TXT, keyed by its device, inode and mtime so a
+# remount or a different board at the same mount point is read again
+_board_ids = {}
+
+def board_id(path):
+    st = os.stat(path + INFO_FILE)
+    key = (path, st.st_dev, st.st_ino, st.st_mtime_ns)
+    if key not in _board_ids:
+        with open(path + INFO_FILE, mode='r') as file:
+            file_content = file.read()
+        _board_ids[key] = re.search(r"Board-ID: ([^\r\n]*)", file_content).group(1)
+    return _board_ids[key]
+
+
+def board_label(path):
+    # Board-ID for messages; a drive given with -d need not have one
+    try:
+        return board_id(path)
+    except (OSError, AttributeError):
+        return "unknown"
+
+
+def usb_serial(path):
+    # Serial number of the USB device behind the drive mounted at `path`,
+    # from sysfs; None where that is not known
+    if sys.platform != "linux" or not os.path.exists(MOUNTINFO):
+        return None
+    path = os.path.realpath(path)
+    for mountpoint, _, source in read_mounts():
+        if mountpoint != path or not source.startswith("/dev/"):
+            continue
+        # The partition's sysfs node sits below the USB device it is on
+        node = os.path.realpath(os.path.join("/sys/class/block",
+                                             os.path.basename(os.path.realpath(source))))
+        while node.startswith("/sys/devices/"):
+            try:
+                with open(os.path.join(node, "serial")) as f:
+                    return f.read().strip() or None
+            except OSError:
+                node = os.path.dirname(node)
+    return None
+
+
+def board_key(path):
+    # Board-ID names a board model, not a board; the USB serial number,
+    # where there is one, tells boards of the same model apart
+    bid = board_id(path)
+    serial = usb_serial(path)
+    return bid if serial == None else "%s/%s" % (bid, serial)
+
+
+def select_boards(drives, boards):
+    # Keep drives whose Board-ID matches one of the `boards` patterns
+    # (fnmatch style, e.g. "ESP32S3-*"); None keeps them all
+    if not boards:
+        return drives
+    import fnmatch
+    selected = []
+    for d in drives:
+        try:
+            bid = board_id(d)
+        except (OSError, AttributeError):
+            continue
+        if any(fnmatch.fnmatchcase(bid, pattern) for pattern in boards):
+            selected.append(d)
+    return selected
+
+
+def list_drives():
+    for d in get_drives():
+        print(d, board_label(d))
+
+
+def write_file(name, buf):
+    with open(name, "wb") as f:
+        f.write(buf)
+    print("Wrote %d bytes to %s" % (len(buf), name))
+
+
+def remove_file(name):
+    # Outputs may be hardlinks into a ConversionCache; writing one in place
+    # would change the cached copy too.
+    try:
+        os.remove(name)
+    except FileNotFoundError:
+        pass
+
+
+def default_cache_dir():
+    # Only cache inside a PlatformIO project, next to its build output
+    if os.path.isdir(".pio"):
+        return os.path.join(".pio", "uf2cache")
+    return None
+
+
+def open_stream(name):
+    reader = sys.stdin.buffer if name == "-" else open(name, "rb")
+    if not reader.seekable():
+        # UF2 headers carry numBlocks, so the input size has to be known
+        # before the first block goes out; spool pipes to disk, not memory.
+        import shutil
+        import tempfile
+        spool = tempfile.TemporaryFile()
+        shutil.copyfileobj(reader, spool, 512 * STREAM_CHUNK_BLOCKS)
+        spool.seek(0)
+        reader = spool
+    return reader
+
+
+def write_stream(names, chunks, log=sys.stdout, devices=(), **writer):
+    # Write every chunk to all outputs as it is produced, so nothing larger
+    # than one chunk is ever held in memory. `devices` are files on
+    # bootloader drives, written through DeviceWriter with the `writer`
+    # options of write_device and only reported once fsync returns.
+    files = []
+    targets = []
+    size = 0
+    try:
+        for name in names:
+            files.append(sys.stdout.buffer if name == "-" else open(name, "wb"))
+        for name in devices:
+            targets.append(DeviceWriter(name, **writer))
+        for chunk in chunks:
+            for f in files:
+                f.write(chunk)
+            for dev in targets:
+                dev.write(chunk)
+            size += len(chunk)
+        for dev in targets:
+            dev.flush()
+            dev.sync()
+    finally:
+        for f in files:
+            if f is sys.stdout.buffer:
+                f.flush()
+            else:
+                f.close()
+        for dev in targets:
+            dev.close()
+    for name in list(names) + list(devices):
+        print("Wrote %d bytes to %s" % (size, name), file=log)
+    return size
+
+
+def deploy_drives(wait, boards=None, device_path=None):
+    if device_path:
+        return [device_path]
+    drives = select_boards(get_drives(), boards)
+    if len(drives) == 0 and wait:
+        print("Waiting for drive to deploy...")
+        drives = wait_for_drives(boards)
+    return drives
+
+
+def open_device_file(name, direct=False, sync=False):
+    # Returns (fd, direct); O_DIRECT is dropped on file systems refusing it
+    flags = os.O_WRONLY | os.O_CREAT | os.O_TRUNC | getattr(os, "O_BINARY", 0)
+    if sync:
+        flags |= getattr(os, "O_SYNC", 0)
+    if direct and hasattr(os, "O_DIRECT"):
+        try:
+            return os.open(name, flags | os.O_DIRECT, 0o666), True
+        except OSError:
+            pass
+    return os.open(name, flags, 0o666), False
+
+
+class DeviceWriter:
+    # A file on a bootloader drive, written in sector-aligned chunks of
+    # `chunk_size` however the data arrives; the caller reports success only
+    # after sync(), once the data has reached the device. With O_DIRECT each
+    # chunk goes through a page-aligned staging buffer, as the kernel
+    # requires. `progress(name, done, total)` is called after every chunk.
+    def __init__(self, name, chunk_size=DEPLOY_CHUNK, direct=False, sync=False, progress=None,
+                 total=None):
+        if chunk_size <= 0 or chunk_size % 512:
+            raise ValueError("Chunk size must be a positive multiple of 512, not %d" % chunk_size)
+        self.name = name
+        self.chunk_size = chunk_size
+        self.progress = progress
+        self.total = total
+        self.done = 0
+        self.pending = bytearray()
+        self.fd, self.direct = open_device_file(name, direct, sync)
+        self.staging = mmap.mmap(-1, chunk_size) if self.direct else None
+
+    def write(self, data):
+        view = memoryview(data)
+        if self.pending:
+            take = self.chunk_size - len(self.pending)
+            self.pending += view[:take]
+            view = view[take:]
+            if len(self.pending) < self.chunk_size:
+                return
+            self._write(self.pending)
+            self.pending = bytearray()
+        whole = len(view) - len(view) % self.chunk_size
+        for ptr in range(0, whole, self.chunk_size):
+            self._write(view[ptr:ptr + self.chunk_size])
+        self.pending += view[whole:]
+
+    def _write(self, chunk):
+        if self.direct:
+            if len(chunk) % 512:
+                # O_DIRECT needs whole sectors; finish through the page cache
+                import fcntl
+                fcntl.fcntl(self.fd, fcntl.F_SETFL,
+                            fcntl.fcntl(self.fd, fcntl.F_GETFL) & ~os.O_DIRECT)
+                self.direct = False
+            else:
+                self.staging[:len(chunk)] = chunk
+                chunk = memoryview(self.staging)[:len(chunk)]
+        done = 0
+        while done < len(chunk):
+            done += os.write(self.fd, chunk[done:])
+        self.done += len(chunk)
+        if self.progress:
+            self.progress(self.name, self.done, self.total)
+
+    def flush(self):
+        # Writes out the last, short chunk
+        if self.pending:
+            self._write(self.pending)
+            self.pending = bytearray()
+
+    def sync(self):
+        os.fsync(self.fd)
+
+    def close(self):
+        os.close(self.fd)
+        if self.staging != None:
+            self.staging.close()
+
+
+def write_device(name, buf, chunk_size=DEPLOY_CHUNK, direct=False, sync=False, progress=None):
+    # Writes `buf` through a DeviceWriter and returns the seconds spent
+    # writing and in the final fsync
+    dev = DeviceWriter(name, chunk_size, direct, sync, progress, len(buf))
+    try:
+        start = time.perf_counter()
+        dev.write(buf)
+        dev.flush()
+        written = time.perf_counter()
+        dev.sync()
+        return written - start, time.perf_counter() - written
+    finally:
+        dev.close()
+
+
+def flash_drive(d, buf, progress=None, **writer):
+    return write_device(d + "/NEW.UF2", buf, progress=progress, **writer)
+
+
+def benchmark_writes(target, size, chunk_sizes=BENCH_CHUNK_SIZES, repeats=3, log=sys.stdout):
+    # Times write_device into `target` (a mounted loopback FAT image, or a
+    # bootloader drive) for every chunk size and open mode. The data is
+    # random, not UF2, so a real bootloader ignores it.
+    data = os.urandom(size - size % 512)
+    name = os.path.join(target, "BENCH.BIN")
+    results = []
+    print("Writing %d bytes to %s, best of %d" % (len(data), name, repeats), file=log)
+    print("%10s %10s %10s %10s" % ("chunk", "mode", "MB/s", "fsync s"), file=log)
+    for mode in ("buffered", "sync", "direct"):
+        if mode == "direct":
+            fd, supported = open_device_file(name, direct=True)
+            os.close(fd)
+            remove_file(name)
+            if not supported:
+                print("O_DIRECT is not supported here; skipping direct mode", file=log)
+                continue
+        for chunk_size in chunk_sizes:
+            best = None
+            for _ in range(repeats):
+                writing, syncing = write_device(name, data, chunk_size,
+                                                direct=(mode == "direct"), sync=(mode == "sync"))
+                remove_file(name)
+                if best == None or writing + syncing < sum(best):
+                    best = (writing, syncing)
+            rate = len(data) / 1e6 / max(sum(best), 1e-9)
+            results.append((rate, chunk_size, mode))
+            print("%10d %10s %10.2f %10.3f" % (chunk_size, mode, rate, best[1]), file=log)
+    rate, chunk_size, mode = max(results)
+    flag = {"buffered": "", "sync": " --sync", "direct": " --direct"}[mode]
+    print("Fastest: --chunk-size %d%s (%.2f MB/s)" % (chunk_size, flag, rate), file=log)
+    return results
+
+
+def benchmark_payloads(target, file_content, conv, sizes=BENCH_PAYLOAD_SIZES, repeats=3,
+                       log=sys.stdout, **writer):
+    # Encodes `file_content` with every payload size and times flashing the
+    # result into `target`, relative to the first size. Against a real
+    # bootloader drive this flashes the board.
+    name = os.path.join(target, "NEW.UF2")
+    results = []
+    print("Flashing %s, best of %d" % (name, repeats), file=log)
+    print("%8s %8s %10s %8s %10s %8s" % ("payload", "blocks", "bytes", "size", "seconds", "time"),
+          file=log)
+    for size in sizes:
+        sized = UF2Converter(conv.base, conv.family, size, conv.erased, conv.md5)
+        buf = sized.to_uf2(file_content)
+        best = None
+        for _ in range(repeats):
+            writing, syncing = write_device(name, buf, **writer)
+            remove_file(name)
+            if best == None or writing + syncing < best:
+                best = writing + syncing
+        results.append((size, len(buf), best))
+        print("%8d %8d %10d %+7.1f%% %10.3f %+7.1f%%" %
+              (size, len(buf) // 512, len(buf), 100.0 * len(buf) / results[0][1] - 100,
+               best, 100.0 * best / max(results[0][2], 1e-9) - 100), file=log)
+    return results
+
+
+def deploy_all(drives, buf, log=sys.stdout, bufs=None, **writer):
+    # Flashes every drive at once from a thread pool; a failing board is
+    # reported and does not stop the others. `bufs` may map drives to their
+    # own image instead of `buf`. Returns the failed drives.
+    bufs = bufs or {}
+    import threading
+    from concurrent.futures import ThreadPoolExecutor, as_completed
+    lock = threading.Lock()
+    def report(msg):
+        with lock:
+            print(msg, file=log)
+    quarters = {}
+    def progress(d, done, total):
+        quarter = 4 * done // max(total, 1)
+        if quarter > quarters.get(d, 0) and quarter < 4:
+            quarters[d] = quarter
+            report("  %s: %d%%" % (d, 25 * quarter))
+    def flash(d):
+        report("Flashing %s (%s)" % (d, board_label(d)))
+        return flash_drive(d, bufs.get(d, buf), progress, **writer)
+    failed = []
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=max(len(drives), 1)) as pool:
+        futures = dict((pool.submit(flash, d), d) for d in drives)
+        for future in as_completed(futures):
+            d = futures[future]
+            try:
+                writing, syncing = future.result()
+            except Exception as e:
+                failed.append(d)
+                report("Failed to flash %s: %s" % (d, e))
+                continue
+            total = writing + syncing
+            size = len(bufs.get(d, buf))
+            report("Wrote %d bytes to %s in %.2fs (%.2f MB/s), fsync done after %.3fs" %
+                   (size, d + "/NEW.UF2", total, size / 1e6 / max(total, 1e-9), syncing))
+    if len(drives) > 1:
+        elapsed = time.perf_counter() - start
+        flashed = [d for d in drives if d not in failed]
+        size = sum(len(bufs.get(d, buf)) for d in flashed)
+        report("Flashed %d of %d boards in %.2fs (%.2f MB/s aggregate)" %
+               (len(flashed), len(drives), elapsed, size / 1e6 / max(elapsed, 1e-9)))
+    return failed
+
+
+def wait_for_remount(d, timeout=VERIFY_TIMEOUT, grace=REMOUNT_GRACE):
+    # Bootloaders reset the board after flashing, so the drive goes away
+    # and comes back, as a new mount, once the board is in bootloader mode
+    # again. Returns False if that takes over `timeout` seconds; a drive
+    # that is still the same mount after `grace` seconds is used as it is.
+    def mounted():
+        try:
+            return os.stat(d + INFO_FILE).st_dev
+        except OSError:
+            return None
+    before = mounted()
+    gone = False
+    start = time.monotonic()
+    while time.monotonic() - start < timeout:
+        now = mounted()
+        if now == None:
+            gone = True
+        elif gone or now != before or time.monotonic() - start > grace:
+            return True
+        sleep(0.05)
+    return False
+
+
+def first_uncovered(ranges, lo, hi):
+    # First address of [lo, hi) outside the sorted, merged `ranges`, or None
+    for start, end in ranges:
+        if end <= lo:
+            continue
+        if start > lo:
+            break
+        lo = end
+        if lo >= hi:
+            return None
+    return lo if lo < hi else None
+
+
+def verify_current(name, expected, offset=0, chunk_size=DEPLOY_CHUNK):
+    # Compares the SparseImage `expected` with a bootloader's CURRENT.UF2
+    # at `name`, where target address A reads as A - offset. Only the
+    # flashed ranges are read, about chunk_size bytes of UF2 at a time, and
+    # the first difference ends it; addresses no block covers differ too.
+    # Returns (address of the first mismatch or None, bytes compared).
+    try:
+        # Make sure the device is read, not what the page cache holds
+        fd = os.open(name, os.O_RDONLY)
+        try:
+            os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+        finally:
+            os.close(fd)
+    except (AttributeError, OSError):
+        pass
+    reader = UF2Reader(name)
+    step = max(chunk_size // 512, 1) * reader.payload_size
+    compared = 0
+    for lo, seg in zip(expected.starts, expected.segments):
+        want = memoryview(seg)
+        for pos in range(0, len(want), step):
+            part = want[pos:pos + step]
+            addr = lo - offset + pos
+            got = reader.read(addr, len(part))
+            # Checked after the read, which may have switched to an index
+            hole = first_uncovered(reader.ranges(), addr, addr + len(part))
+            n = len(part) if hole == None else hole - addr
+            if got[:n] != part[:n]:
+                n = next(k for k in range(n) if got[k] != part[k])
+                return lo + pos + n, compared + n
+            if hole != None:
+                return hole + offset, compared + n
+            compared += n
+    return None, compared
+
+
+def verify_all(drives, buf, log=sys.stdout, bufs=None, offset=None, chunk_size=DEPLOY_CHUNK):
+    # Waits for every flashed drive to come back and checks its CURRENT.UF2
+    # against what was sent, all boards at once; `offset` as for
+    # verify_current, by default 0, as UF2 files use the addresses
+    # CURRENT.UF2 lists. Returns the drives that did not verify.
+    import threading
+    from concurrent.futures import ThreadPoolExecutor, as_completed
+    lock = threading.Lock()
+    def report(msg):
+        with lock:
+            print(msg, file=log)
+    bufs = bufs or {}
+    def verify(d):
+        if not wait_for_remount(d):
+            raise ValueError("did not come back within %ds" % VERIFY_TIMEOUT)
+        images = UF2Converter().split_uf2(bufs.get(d, buf))
+        with open(d + CURRENT_FILE, "rb") as f:
+            hd = UF2_HEADER.unpack(read_full(f, 32))
+        family = hd[7] if hd[2] & 0x2000 else 0x0
+        expected = images.get(family) or (list(images.values())[0] if len(images) == 1 else None)
+        if expected == None:
+            raise ValueError("holds family 0x%08x, which was not flashed" % family)
+        if offset == None and expected.start and partition_relative(family):
+            # Such an image lands that far into the app partition, where it
+            # does not boot, and reading it back from there would still pass
+            raise ValueError("was sent an image at 0x%x, but %s bootloaders number the app "
+                             "partition from 0; convert with -b 0x0, or pass --verify-offset "
+                             "if that is intended" %
+                             (expected.start, uf2families.load().name_of(family)))
+        begin = time.perf_counter()
+        mismatch, compared = verify_current(d + CURRENT_FILE, expected, offset or 0, chunk_size)
+        return mismatch, compared, time.perf_counter() - begin
+    failed = []
+    with ThreadPoolExecutor(max_workers=max(len(drives), 1)) as pool:
+        futures = dict((pool.submit(verify, d), d) for d in drives)
+        for future in as_completed(futures):
+            d = futures[future]
+            try:
+                mismatch, compared, elapsed = future.result()
+            except (OSError, ValueError) as e:
+                failed.append(d)
+                report("Could not verify %s: %s" % (d, e))
+                continue
+            if mismatch != None:
+                failed.append(d)
+                report("Verify FAILED for %s: first difference at 0x%08x" % (d, mismatch))
+            else:
+                report("Verified %d bytes on %s in %.2fs (%.2f MB/s)" %
+                       (compared, d, elapsed, compared / 1e6 / max(elapsed, 1e-9)))
+    return failed
+
+
+def check_payload_size(size, family, md5=False):
+    # Payloads stay word-aligned so skipped and sparse regions decode as
+    # whole-word padding
+    limit = UF2_MAX_MD5_PAYLOAD if md5 else UF2_MAX_PAYLOAD
+    if size <= 0 or size > limit or size % 4:
+        raise ValueError("Payload size must be a multiple of 4 from 4 to %d%s, not %d" %
+                         (limit, " with MD5 checksums" if md5 else "", size))
+    name = uf2families.load().name_of(family)
+    if size != 256 and name in FIXED_PAYLOAD_FAMILIES:
+        raise ValueError("%s bootloaders only accept 256-byte payloads" % name)
+
+
+def partition_relative(family):
+    return uf2families.load().name_of(family) in PARTITION_RELATIVE_FAMILIES
+
+
+def load_families():
+    # Short name -> family ID; see uf2families.py for how the table is cached
+    return uf2families.load().by_name
+
+
+def parse_size(value):
+    # "65536", "0x10000", "64K" or "1M"
+    scale = {"K": 1024, "M": 1024 * 1024}.get(value[-1:].upper(), 1)
+    if scale != 1:
+        value = value[:-1]
+    return int(value, 0) * scale
+
+
+def read_partitions(path):
+    # ESP-IDF partition table CSV -> [(name, type, subtype, offset, size)],
+    # filling in blank offsets the way gen_esp32part.py does
+    parts = []
+    # First free offset after the bootloader and the table at 0x8000
+    offset = 0x9000
+    with open(path) as f:
+        for line in f:
+            line = line.split("#", 1)[0].strip()
+            if not line:
+                continue
+            name, ptype, subtype, start, size = ([field.strip() for field in line.split(",")] +
+                                                 [""] * 5)[:5]
+            try:
+                align = 0x10000 if ptype == "app" else 0x1000
+                start = parse_size(start) if start else (offset + align - 1) // align * align
+                size = parse_size(size)
+            except ValueError:
+                raise ValueError("Bad offset or size for partition %s in %s" % (name, path))
+            # gen_esp32part.py refuses these too; flash is erased in sectors
+            if start % align:
+                raise ValueError("Partition %s at 0x%x in %s is not aligned to 0x%x" %
+                                 (name, start, path, align))
+            parts.append((name, ptype, subtype, start, size))
+            offset = start + size
+    return parts
+
+
+def parse_family(value):
+    # Family by short name (any case) or number, as accepted by --family
+    families = uf2families.load()
+    family = families.id_of(value)
+    if family != None:
+        return family
+    try:
+        return int(value, 0)
+    except ValueError:
+        raise ValueError("Family ID needs to be a number or one of: " + ", ".join(families.by_name.keys()))
+
+
+def main():
+    def error(msg):
+        print(msg, file=sys.stderr)
+        sys.exit(1)
+    commands = {"bundle": bundle_main, "diff": diff_main, "store": store_main}
+    if sys.argv[1:2] and sys.argv[1] in commands:
+        commands[sys.argv[1]](sys.argv[2:], error)
+        return
+    parser = argparse.ArgumentParser(description='Convert to UF2 or flash directly.',
+                                     epilog='Other commands: bundle, diff and store; see '
+                                            '"uf2conv.py COMMAND -h".')
+    parser.add_argument('input', metavar='INPUT', type=str, nargs='?',
+                        help='input file (HEX, BIN, ELF or UF2)')
+    parser.add_argument('-b', '--base', dest='base', type=str,
+                        default="0x2000",
+                        help='set base address of application for BIN format (default: 0x2000)')
+    parser.add_argument('-f', '--family', dest='family', type=str,
+                        default="0x0",
+                        help='specify familyID - number or name (default: 0x0)')
+    parser.add_argument('-o', '--output', metavar="FILE", dest='output', type=str,
+                        help='write output to named file; defaults to "flash.uf2" or "flash.bin" where sensible')
+    parser.add_argument('-d', '--device', dest="device_path",
+                        help='select a device path to flash')
+    parser.add_argument('-l', '--list', action='store_true',
+                        help='list connected devices')
+    parser.add_argument('-c', '--convert', action='store_true',
+                        help='do not flash, just convert')
+    parser.add_argument('-D', '--deploy', action='store_true',
+                        help='just flash, do not convert')
+    parser.add_argument('-w', '--wait', action='store_true',
+                        help='wait for device to flash')
+    parser.add_argument('--chunk-size', type=parse_size, default=DEPLOY_CHUNK,
+                        help='bytes per write when flashing, a multiple of 512; K and M '
+                             'suffixes allowed (default: 64K)')
+    parser.add_argument('--direct', action='store_true',
+                        help='flash with O_DIRECT, bypassing the page cache where supported')
+    parser.add_argument('--sync', action='store_true',
+                        help='flash with O_SYNC')
+    parser.add_argument('--benchmark', metavar='DIR', type=str,
+                        help='measure write throughput per chunk size and mode in DIR, e.g. a '
+                             'loopback FAT image (truncate -s 8M fat.img; mkfs.fat fat.img; '
+                             'mount -o loop fat.img DIR), do not convert')
+    parser.add_argument('--verify', action='store_true',
+                        help='after flashing, wait for each board to come back and compare its '
+                             'CURRENT.UF2 with what was flashed')
+    parser.add_argument('--verify-offset', metavar='ADDR', type=str,
+                        help='target address that CURRENT.UF2 lists as 0 (default: 0, as UF2 '
+                             'files and CURRENT.UF2 share their addressing; ESP32-S2/S3 number '
+                             'the app partition from 0 in both)')
+    parser.add_argument('-B', '--boards', metavar='BOARD-ID', type=str,
+                        help='only flash drives whose Board-ID matches one of these comma-separated '
+                             'patterns (e.g. "ESP32S3-*")')
+    parser.add_argument('-p', '--payload-size', metavar='BYTES', type=str, default="256",
+                        help='data bytes per UF2 block when encoding, a multiple of 4 up to '
+                             '476; many bootloaders only accept 256 (default: 256)')
+    parser.add_argument('-m', '--md5', action='store_true',
+                        help='add the MD5 of every block\'s payload (flag 0x4000) so supporting '
+                             'bootloaders skip unchanged pages; payload size at most 452')
+    parser.add_argument('-E', '--skip-erased', action='store_true',
+                        help='leave out chunks that are entirely erased flash when encoding, and '
+                             'fill gaps with erased flash when decoding')
+    parser.add_argument('--erased-value', metavar='VALUE', type=str,
+                        help='value of erased flash for -E, which it implies (default: 0xff)')
+    parser.add_argument('-C', '--carray', action='store_true',
+                        help='convert binary file to a C array, not UF2')
+    parser.add_argument('--carray-words', action='store_true',
+                        help='with --carray, emit 32-bit little-endian words (about 4x fewer tokens)')
+    parser.add_argument('--incbin', action='store_true',
+                        help='write an assembler file that .incbin\'s INPUT (path kept as given) '
+                             'plus a matching header, instead of a C array')
+    parser.add_argument('--delta', action='store_true',
+                        help='only write blocks that differ from what each board was last '
+                             'flashed with by uf2conv')
+    parser.add_argument('--delta-from', metavar='PREVIOUS', type=str,
+                        help='only write blocks that differ from the UF2 file PREVIOUS')
+    parser.add_argument('--no-cache', action='store_true',
+                        help='always convert, ignoring the conversion cache')
+    parser.add_argument('--cache-dir', metavar='DIR', type=str,
+                        help='cache BIN to UF2 conversions in DIR (default: .pio/uf2cache '
+                             'inside a PlatformIO project)')
+    parser.add_argument('-i', '--info', action='store_true',
+                        help='display header information from UF2, do not convert')
+    parser.add_argument('-V', '--validate', action='store_true',
+                        help='check every block of a UF2 file and report all problems, do not convert')
+    parser.add_argument('--split', action='store_true',
+                        help='decode a multi-family UF2 file in one pass into flash_<FAMILY>.bin '
+                             'per family, in the --output directory if given')
+    parser.add_argument('-r', '--read', metavar='ADDR:LENGTH', type=str,
+                        help='print LENGTH bytes at target address ADDR of a UF2 file using a '
+                             'cached block index (or write them to --output), do not convert')
+    parser.add_argument('-s', '--stream', action='store_true',
+                        help='convert BIN or UF2 in fixed-size chunks with constant memory; '
+                             'INPUT and --output may be "-" for stdin/stdout')
+    args = parser.parse_args()
+    if args.boards:
+        args.boards = [pattern.strip() for pattern in args.boards.split(",")]
+    if args.chunk_size <= 0 or args.chunk_size % 512:
+        error("--chunk-size must be a positive multiple of 512")
+
+    try:
+        conv = UF2Converter(int(args.base, 0), parse_family(args.family),
+                            int(args.payload_size, 0), md5=args.md5)
+        check_payload_size(conv.payload_size, conv.family, conv.md5)
+        verify_offset = None if args.verify_offset == None else int(args.verify_offset, 0)
+        if args.skip_erased or args.erased_value != None:
+            conv.erased = int(args.erased_value or "0xff", 0)
+            if not 0 <= conv.erased <= 0xff:
+                raise ValueError("Erased value must be a byte, not %s" % args.erased_value)
+    except ValueError as e:
+        error(str(e))
+
+    if args.list:
+        list_drives()
+    elif args.benchmark:
+        size = 2 * 1024 * 1024
+        if args.input:
+            size = os.path.getsize(args.input)
+        try:
+            benchmark_writes(args.benchmark, size)
+            if args.input:
+                with open(args.input, "rb") as f:
+                    inpbuf = f.read()
+                if not is_uf2(inpbuf) and not is_hex(inpbuf):
+                    sizes = BENCH_PAYLOAD_SIZES
+                    if conv.md5:
+                        sizes = tuple(min(size, UF2_MAX_MD5_PAYLOAD) for size in sizes)
+                    if conv.payload_size not in sizes:
+                        sizes += (conv.payload_size,)
+                    if uf2families.load().name_of(conv.family) in FIXED_PAYLOAD_FAMILIES:
+                        sizes = (256,)
+                    print("", file=sys.stdout)
+                    benchmark_payloads(args.benchmark, inpbuf, conv, sizes,
+                                       chunk_size=args.chunk_size, direct=args.direct,
+                                       sync=args.sync)
+        except (OSError, ValueError) as e:
+            error(str(e))
+    else:
+        if not args.input:
+            error("Need input file")
+        if args.validate:
+            validate_main(args, error)
+            return
+        if args.read:
+            read_main(args, conv, error)
+            return
+        if args.stream:
+            if args.verify:
+                error("--verify does not work with --stream")
+            if args.delta or args.delta_from:
+                error("--delta does not work with --stream")
+            stream_main(args, conv, error)
+            return
+        if args.split:
+            split_main(args, conv, error)
+            return
+        with open(args.input, mode='rb') as f:
+            inpbuf = f.read(512)
+            from_uf2 = is_uf2(inpbuf)
+            from_elf = is_elf(inpbuf) and not args.carray and not args.incbin
+            if (from_uf2 or from_elf) and not args.deploy:
+                # Decode straight from the page cache
+                inpbuf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            else:
+                inpbuf += f.read()
+        ext = "uf2"
+        written = None
+        if args.deploy:
+            outbuf = inpbuf
+        elif from_uf2 and not args.info:
+            try:
+                outbuf = conv.from_uf2(inpbuf, sys.stdout)
+            except ValueError as e:
+                error(str(e))
+            ext = "bin"
+        elif from_uf2 and args.info:
+            outbuf = ""
+            try:
+                conv.from_uf2(inpbuf, sys.stdout)
+            except ValueError as e:
+                error(str(e))
+            # ESP-IDF apps also get their header shown; other images are
+            # not ESP app images and are skipped
+            import esp_image
+            try:
+                image = esp_image.EspImage.from_uf2(args.input, family=conv.family or None)
+                for line in esp_image.describe(image):
+                    print(line)
+            except ValueError:
+                pass
+        elif is_hex(inpbuf):
+            try:
+                outbuf = conv.from_hex(inpbuf.decode("utf-8"))
+            except ValueError as e:
+                error(str(e))
+        elif from_elf:
+            try:
+                outbuf = conv.from_elf(inpbuf)
+            except ValueError as e:
+                error(str(e))
+        elif args.incbin:
+            if args.output == None:
+                args.output = "flash.S"
+            write_incbin(args.output, args.input, len(inpbuf))
+            return
+        elif args.carray:
+            if args.output == None:
+                args.output = "flash.h"
+            with open(args.output, "w", newline="") as f:
+                write_carray(f, inpbuf, args.carray_words)
+            print("Converted to h, output size: %d, wrote %s" %
+                  (os.path.getsize(args.output), args.output))
+            return
+        else:
+            if args.convert and args.output == None:
+                args.output = "flash.uf2"
+            # The cache holds full conversions, not deltas
+            cachedir = None if args.no_cache or args.delta_from else (args.cache_dir or default_cache_dir())
+            if cachedir and args.output:
+                cache = ConversionCache(cachedir)
+                cachekey = cache.key(args.input, conv, "uf2")
+                if cache.fetch(cachekey, args.output):
+                    print("Reused cached conversion for %s" % args.output)
+                    with open(args.output, "rb") as f:
+                        outbuf = f.read()
+                else:
+                    outbuf = conv.to_uf2(inpbuf)
+                    remove_file(args.output)
+                    write_file(args.output, outbuf)
+                    cache.store(cachekey, args.output)
+                # Already written (or linked) above
+                written = args.output
+            else:
+                outbuf = conv.to_uf2(inpbuf)
+        if not args.deploy and not args.info:
+            print("Converted to %s, output size: %d, start address: 0x%x" %
+                  (ext, len(outbuf), conv.base))
+        if ext == "uf2" and args.delta_from and not args.info:
+            try:
+                with open(args.delta_from, "rb") as f:
+                    previous = block_digests(f.read())
+            except OSError as e:
+                error(str(e))
+            numblocks = len(outbuf) // 512
+            outbuf = delta_uf2(outbuf, previous)
+            print("Delta against %s: %d of %d blocks changed" %
+                  (args.delta_from, len(outbuf) // 512, numblocks))
+        if args.convert or ext != "uf2":
+            if args.output == None:
+                args.output = "flash." + ext
+        if args.output and args.output != written:
+            remove_file(args.output)
+            write_file(args.output, outbuf)
+        if ext == "uf2" and not args.convert and not args.info:
+            drives = deploy_drives(args.wait, args.boards, args.device_path)
+            if len(drives) == 0 and not args.output:
+                error("No drive to deploy.")
+            records = BoardRecords()
+            keys = {}
+            for d in drives:
+                try:
+                    keys[d] = board_key(d)
+                except (OSError, AttributeError):
+                    pass
+            bufs = {}
+            if args.delta and not args.delta_from:
+                for key in set(keys.values()):
+                    shared = [d for d in drives if keys.get(d) == key]
+                    if len(shared) > 1:
+                        error("%s all report %s and cannot be told apart; flash them without "
+                              "--delta, or with --delta-from PREVIOUS" % (", ".join(shared), key))
+                for d, key in keys.items():
+                    bufs[d] = delta_uf2(outbuf, records.load(key))
+                    print("Delta for %s (%s): %d of %d blocks changed" %
+                          (d, key, len(bufs[d]) // 512, len(outbuf) // 512))
+            failed = deploy_all(drives, outbuf, bufs=bufs, chunk_size=args.chunk_size,
+                                direct=args.direct, sync=args.sync)
+            unverified = []
+            if args.verify:
+                flashed = [d for d in drives if d not in failed]
+                unverified = verify_all(flashed, outbuf, bufs=bufs, offset=verify_offset,
+                                        chunk_size=args.chunk_size)
+            # A board that failed to flash or verify holds something other
+            # than what was sent; drop its record, whichever other drive
+            # shares it
+            bad = set(keys[d] for d in failed + unverified if d in keys)
+            for d, key in keys.items():
+                if key not in bad:
+                    records.update(key, block_digests(bufs.get(d, outbuf)))
+            for key in bad:
+                records.forget(key)
+            if failed:
+                error("%d of %d boards failed to flash" % (len(failed), len(drives)))
+            if unverified:
+                error("%d of %d boards failed verification" % (len(unverified), len(drives)))
+
+
+def validate_main(args, error):
+    with open(args.input, "rb") as f:
+        if os.fstat(f.fileno()).st_size < 512:
+            error("%s is too small to be a UF2 file" % args.input)
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+            problems, summary = validate_uf2(m)
+    for line in summary:
+        print(line)
+    for line in problems:
+        print(line)
+    if problems:
+        error("%d problem(s) found in %s" % (len(problems), args.input))
+    print("No problems found in %s" % args.input)
+
+
+def read_main(args, conv, error):
+    try:
+        addr, length = [int(v, 0) for v in args.read.split(":")]
+    except ValueError:
+        error("--read needs ADDR:LENGTH, e.g. 0x10020:256")
+    with open(args.input, "rb") as f:
+        if not is_uf2(f.read(8)):
+            error("--read needs UF2 input")
+    index = UF2Index(args.input, uf2cache.user_cache_dir())
+    data = index.read(addr, length, conv.family or None)
+    if args.output:
+        write_file(args.output, data)
+        return
+    for ptr in range(0, len(data), 16):
+        print("%08x  %s" % (addr + ptr, data[ptr:ptr + 16].hex(" ")))
+
+
+def bundle_partitions(parts, files):
+    # A SparseImage holding each (partition name, file name) of `files` at
+    # its partition's offset from `parts` (as from read_partitions)
+    ordered = sorted(parts, key=lambda part: part[3])
+    for a, b in zip(ordered, ordered[1:]):
+        if a[3] + a[4] > b[3]:
+            raise ValueError("Partitions %s and %s overlap" % (a[0], b[0]))
+    byname = dict((part[0], part) for part in parts)
+    image = SparseImage()
+    seen = set()
+    for name, filename in files:
+        if name not in byname:
+            raise ValueError("No partition named %s; the table has %s" %
+                             (name, ", ".join(part[0] for part in parts)))
+        if name in seen:
+            raise ValueError("Partition %s is given twice" % name)
+        seen.add(name)
+        offset, size = byname[name][3:5]
+        with open(filename, "rb") as f:
+            data = f.read()
+        if len(data) > size:
+            raise ValueError("%s is %d bytes, but partition %s only holds %d" %
+                             (filename, len(data), name, size))
+        image.add(offset, data)
+    return image
+
+
+def diff_main(argv, error):
+    parser = argparse.ArgumentParser(prog='uf2conv.py diff',
+                                     description='List the target address ranges whose block '
+                                                 'payloads differ between two UF2 files or stored '
+                                                 'artifacts. Exits with 1 if any do, and with 2 '
+                                                 'on bad input.')
+    parser.add_argument('old', metavar='A', help='UF2 file, or stored artifact name or ID')
+    parser.add_argument('new', metavar='B', help='UF2 file, or stored artifact name or ID')
+    parser.add_argument('--store', metavar='DIR',
+                        help='artifact store for names that are not files '
+                             '(default: ~/.cache/uf2conv/store)')
+    args = parser.parse_args(argv)
+    def fail(msg):
+        # Status 1 means the inputs differ, so errors exit like argparse's
+        print(msg, file=sys.stderr)
+        sys.exit(2)
+    store = ArtifactStore(args.store)
+    try:
+        refs = []
+        for ref in (args.old, args.new):
+            if os.path.exists(ref):
+                with open(ref, "rb") as f:
+                    buf = f.read()
+                if len(buf) < 512 or not is_uf2(buf):
+                    fail("%s is not a UF2 file" % ref)
+                refs.append((None, buf))
+            else:
+                refs.append((store.resolve(ref), None))
+        if refs[0][0] and refs[1][0]:
+            # Both stored: equal payloads share a pack offset
+            maps = [store.block_map(artifact) for artifact, _ in refs]
+        else:
+            maps = [block_digests(buf if buf != None else store.rebuild(artifact))
+                    for artifact, buf in refs]
+    except (OSError, ValueError) as e:
+        fail(str(e))
+    ranges = diff_blocks(maps[0], maps[1])
+    print("--- %s\n+++ %s" % (args.old, args.new))
+    for start, end, kind in ranges:
+        print("%-8s 0x%08x-0x%08x (%d bytes)" % (kind, start, end, end - start))
+    total = sum(length for _, length, _ in maps[1].values())
+    changed = sum(end - start for start, end, kind in ranges if kind != "removed")
+    print("%d range(s) differ; %d of %d bytes of B are new or changed" %
+          (len(ranges), changed, total))
+    if ranges:
+        sys.exit(1)
+
+
+def store_main(argv, error):
+    parser = argparse.ArgumentParser(prog='uf2conv.py store',
+                                     description='Content-addressed UF2 archive that keeps every '
+                                                 'distinct block payload once.')
+    parser.add_argument('--store', metavar='DIR',
+                        help='store directory (default: ~/.cache/uf2conv/store)')
+    commands = parser.add_subparsers(dest='command')
+    add = commands.add_parser('add', help='store UF2 files under their paths as given')
+    add.add_argument('files', metavar='FILE', nargs='+')
+    get = commands.add_parser('get', help='rebuild a stored UF2 file')
+    get.add_argument('artifact', metavar='NAME|ID')
+    get.add_argument('-o', '--output', metavar='FILE',
+                     help='file to write (default: the name it was stored under)')
+    commands.add_parser('list', help='list stored names')
+    args = parser.parse_args(argv)
+    store = ArtifactStore(args.store)
+    try:
+        if args.command == 'add':
+            for name in args.files:
+                with open(name, "rb") as f:
+                    if not is_uf2(f.read(512)):
+                        error("%s is not a UF2 file" % name)
+                artifact, new, replaced = store.add(name)
+                print("%s %s, %d new payload(s)" % (artifact[:12], name, new))
+                if replaced:
+                    print("Warning: %s referred to %s before; that artifact is still "
+                          "stored under its ID" % (os.path.normpath(name), replaced[:12]),
+                          file=sys.stderr)
+            print("%d artifact(s), %d bytes of unique payloads" %
+                  (len(store.names()), store.packed_size()))
+        elif args.command == 'get':
+            artifact = store.resolve(args.artifact)
+            output = args.output
+            if output == None:
+                output = [name for name, found in store.names().items() if found == artifact] or \
+                         [artifact + ".uf2"]
+                output = os.path.basename(output[0])
+            remove_file(output)
+            write_file(output, store.rebuild(artifact))
+        elif args.command == 'list':
+            for name, artifact in sorted(store.names().items()):
+                print("%s %s" % (artifact[:12], name))
+        else:
+            parser.print_help()
+    except (OSError, ValueError) as e:
+        error(str(e))
+
+
+def bundle_main(argv, error):
+    parser = argparse.ArgumentParser(prog='uf2conv.py bundle',
+                                     description='Combine one image per partition into a single UF2. '
+                                                 'Partitions without an image are left out, so '
+                                                 'their flash contents stay as they are.')
+    parser.add_argument('images', metavar='NAME=FILE', nargs='+',
+                        help='raw image for the partition NAME, e.g. app0=firmware.bin')
+    parser.add_argument('-t', '--partitions', metavar='CSV', default='partitions.csv',
+                        help='ESP-IDF partition table (default: partitions.csv)')
+    parser.add_argument('-f', '--family', dest='family', type=str, default="0x0",
+                        help='specify familyID - number or name (default: 0x0)')
+    parser.add_argument('-o', '--output', metavar='FILE', default='bundle.uf2',
+                        help='UF2 file to write (default: bundle.uf2); flash it with -D')
+    parser.add_argument('-p', '--payload-size', metavar='BYTES', type=str, default="256",
+                        help='data bytes per UF2 block (default: 256)')
+    parser.add_argument('-m', '--md5', action='store_true',
+                        help='add the MD5 of every block\'s payload (flag 0x4000)')
+    args = parser.parse_args(argv)
+    files = []
+    for spec in args.images:
+        name, sep, filename = spec.partition("=")
+        if not sep or not name or not filename:
+            error("Images are given as NAME=FILE, not %s" % spec)
+        files.append((name, filename))
+    try:
+        conv = UF2Converter(0x0, parse_family(args.family), int(args.payload_size, 0),
+                            md5=args.md5)
+        check_payload_size(conv.payload_size, conv.family, conv.md5)
+        if partition_relative(conv.family):
+            raise ValueError("%s bootloaders only write the app partition; bundles need one "
+                             "that takes flash addresses" % uf2families.load().name_of(conv.family))
+        parts = read_partitions(args.partitions)
+        image = bundle_partitions(parts, files)
+    except (OSError, ValueError) as e:
+        error(str(e))
+    given = dict(files)
+    for name, _, _, offset, size in parts:
+        if name in given:
+            print("%-10s 0x%08x %s, %d of %d bytes" %
+                  (name, offset, given[name], os.path.getsize(given[name]), size))
+    # Each partition's blocks start at its own offset, and its last block
+    # ends at its end at the latest
+    bounds = [part[3] for part in parts] + [part[3] + part[4] for part in parts]
+    outbuf = conv.from_image(image, bounds)
+    remove_file(args.output)
+    write_file(args.output, outbuf)
+
+
+def split_main(args, conv, error):
+    with open(args.input, "rb") as f:
+        if not is_uf2(f.read(512)):
+            error("--split needs UF2 input")
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+            try:
+                images = conv.split_uf2(m)
+            except ValueError as e:
+                error(str(e))
+    if conv.erased == None and any(len(image.segments) > 1 for image in images.values()):
+        print(GAP_WARNING, file=sys.stderr)
+    families = uf2families.load()
+    outdir = args.output or "."
+    for family, image in sorted(images.items(), key=lambda item: item[1].start):
+        name = families.name_of(family) or "0x%08x" % family
+        outname = os.path.join(outdir, "flash_%s.bin" % name)
+        print("Family %s (0x%08x), start address: 0x%x" % (name, family, image.start))
+        remove_file(outname)
+        write_file(outname, image.tobytes(conv.erased or 0))
+
+
+def stream_main(args, conv, error):
+    reader = open_stream(args.input)
+    head = reader.read(512)
+    reader.seek(0)
+    # Keep stdout clean when it carries the converted image
+    log = sys.stderr if args.output == "-" else sys.stdout
+    ext = "uf2"
+    if args.deploy:
+        chunks = iter(lambda: reader.read(512 * STREAM_CHUNK_BLOCKS), b"")
+    elif is_uf2(head) and not args.info:
+        chunks = conv.iter_payload(reader)
+        ext = "bin"
+    elif args.info or args.carray or is_hex(head) or is_elf(head):
+        error("--stream only converts BIN and UF2 input")
+    else:
+        chunks = conv.iter_uf2_blocks(reader)
+    if args.convert or ext != "uf2":
+        if args.output == None:
+            args.output = "flash." + ext
+    names = [args.output] if args.output else []
+    devices = []
+    if args.output and args.output != "-":
+        remove_file(args.output)
+    if ext == "uf2" and not args.convert:
+        drives = deploy_drives(args.wait, args.boards, args.device_path)
+        if len(drives) == 0 and not args.output:
+            error("No drive to deploy.")
+        for d in drives:
+            print("Flashing %s (%s)" % (d, board_label(d)), file=log)
+            devices.append(d + "/NEW.UF2")
+    try:
+        size = write_stream(names, chunks, log, devices, chunk_size=args.chunk_size,
+                            direct=args.direct, sync=args.sync)
+    except (OSError, ValueError) as e:
+        error(str(e))
+    if not args.deploy:
+        print("Converted to %s, output size: %d, start address: 0x%x" %
+              (ext, size, conv.base), file=log)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,83 @@
+#!/usr/bin/env python3
+# UF2 family registry built from `uf2families.json`.
+#
+# The JSON table is parsed once and the compiled maps are pickled next to
+# it (or into the per-user cache directory when the script directory is
+# read-only), keyed by the JSON file's size and mtime. Later runs only
+# unpickle two dicts, and look-ups in either direction are O(1).
+import os
+import pickle
+
+import uf2cache
+
+JSON_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "uf2families.json")
+CACHE_NAME = "uf2families.pickle"
+CACHE_VERSION = 1
+
+_registry = None
+
+
+class FamilyRegistry:
+    def __init__(self, by_name, descriptions):
+        # short name -> family ID, in uf2families.json order
+        self.by_name = by_name
+        # family ID -> short name
+        self.by_id = dict((value, name) for name, value in by_name.items())
+        self._by_upper = dict((name.upper(), value) for name, value in by_name.items())
+        self.descriptions = descriptions
+
+    def id_of(self, name):
+        # Case-insensitive, as --family has always upper-cased its argument
+        return self._by_upper.get(name.upper())
+
+    def name_of(self, family, default=""):
+        return self.by_id.get(family, default)
+
+
+def _cache_paths():
+    return [os.path.join(os.path.dirname(JSON_PATH), CACHE_NAME),
+            os.path.join(uf2cache.user_cache_dir(), CACHE_NAME)]
+
+
+def _compile(path):
+    import json
+    with open(path) as f:
+        raw_families = json.load(f)
+    by_name = {}
+    descriptions = {}
+    for family in raw_families:
+        by_name[family["short_name"]] = int(family["id"], 0)
+        descriptions[family["short_name"]] = family.get("description", "")
+    return by_name, descriptions
+
+
+def load(path=JSON_PATH):
+    """Return the FamilyRegistry for `path`, compiling it at most once"""
+    global _registry
+    if _registry != None and path == JSON_PATH:
+        return _registry
+    st = os.stat(path)
+    key = (os.path.abspath(path), st.st_size, st.st_mtime_ns)
+    cachefiles = _cache_paths() if path == JSON_PATH else []
+    for cachefile in cachefiles:
+        try:
+            with open(cachefile, "rb") as f:
+                version, cachedkey, by_name, descriptions = pickle.load(f)
+        except (OSError, EOFError, ValueError, pickle.UnpicklingError):
+            continue
+        if version == CACHE_VERSION and cachedkey == key:
+            break
+    else:
+        by_name, descriptions = _compile(path)
+        for cachefile in cachefiles:
+            if uf2cache.save_pickle(cachefile, (CACHE_VERSION, key, by_name, descriptions)):
+                break
+    registry = FamilyRegistry(by_name, descriptions)
+    if path == JSON_PATH:
+        _registry = registry
+    return registry
+
+
+if __name__ == "__main__":
+    for name, value in load().by_name.items():
+        print("0x%08x  %s" % (value, name))